@@ -1,12 +1,68 @@
 from abc import ABC, abstractmethod
+import numpy as np
 import pandas as pd
-from typing import List, Union
+from typing import Dict, List, Literal, Union
 from pydantic import BaseModel
 import inspect
-import json
+import orjson
 import base64, hashlib
+import functools
+import os
+from collections import OrderedDict
+
+# Rows per parquet row group written by save_to, large enough that per row group metadata stays negligible
+ROW_GROUP_SIZE = 1_000_000
+
+# Length of the feature hash, feature names that already carry a hash have the format FEATURENAME$HASH
+HASH_LENGTH = 10
+
+@functools.lru_cache(maxsize=1024)
+def _to_utc_ts(ts: Union[str, pd.Timestamp]) -> pd.Timestamp:
+    """
+    Convert a string or pd.Timestamp to a timezone-aware pd.Timestamp, treating naive values as UTC.
+    Cached since nested features convert the same start/end values over and over.
+    """
+    if isinstance(ts, str):
+        # Parsing with tz directly localizes naive strings (and converts offset strings) in one construction
+        return pd.Timestamp(ts, tz='UTC')
+    return ts.tz_localize('UTC') if ts.tz is None else ts
+
+def _hstack_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate feature outputs column-wise. When all frames share the same index and are float
+    typed, their values are copied once into a single preallocated block instead of letting
+    pd.concat align every index and merge block managers; otherwise this falls back to pd.concat.
+    """
+    common_index = frames[0].index
+    dtypes = [dtype for frame in frames for dtype in frame.dtypes]
+    if not all(frame.index.equals(common_index) for frame in frames[1:]) or not all(dtype.kind == 'f' for dtype in dtypes):
+        return pd.concat(frames, axis = 1)
+    
+    # Column-major so the block is handed to pandas without another copy
+    out = np.empty((len(common_index), len(dtypes)), dtype=np.result_type(*dtypes), order='F')
+    np.concatenate([frame.to_numpy() for frame in frames], axis=1, out=out)
+    columns = frames[0].columns.append([frame.columns for frame in frames[1:]])
+    
+    return pd.DataFrame(out, index=common_index, columns=columns)
 
 class Feature:
+    # Digest of each class's source code keyed by class, filled on first instantiation (see __compute_hash)
+    _class_source_hash: Dict[type, bytes] = {}
+    
+    # LRU cache of _compute_impl outputs keyed by (hash, start_ns, end_ns, OHLCV path and mtime), shared by all
+    # features. It holds at most compute_cache_size outputs taking compute_cache_max_bytes in total, set either
+    # to 0 to disable it
+    _compute_cache = OrderedDict()
+    _compute_cache_bytes = 0
+    compute_cache_size = 32
+    compute_cache_max_bytes = 1 << 30
+    # Optional directory for an on-disk parquet cache of _compute_impl outputs, disabled when None.
+    # Invalidation: in-memory entries stop being served (and age out) once the configured OHLCV file or directory gets
+    # a new mtime. The config is read once per process, so after changing ohlcv_path or rewriting a file inside
+    # a partitioned directory call OHLCV.clear_cache(). On-disk entries are keyed by feature hash and range only,
+    # so clear cache_dir by hand when the underlying OHLCV data changes
+    cache_dir = None
+    
     def __init__(self, pairs: Union[str, List[str]], **kwargs):
         self.kwargs = kwargs
         # Convert string pairs to list if needed
@@ -16,7 +72,7 @@ class Feature:
             self.pairs = pairs
             
         #For now for convenience we will only use the first 10 characters of the hash
-        self.hash = self.__compute_hash()[:10]
+        self.hash = self.__compute_hash()[:HASH_LENGTH]
     
     def _ensure_multiindex_columns(self, output: pd.DataFrame) -> pd.DataFrame:
         """
@@ -24,34 +80,28 @@ class Feature:
         pairs as the first level and the feature class name as the second level.
         """
         if not isinstance(output.columns, pd.MultiIndex):
-            # Get the feature class name
-            feature_name = self.__class__.__name__
-            pairs = output.columns
-            
-            # Create MultiIndex columns with pairs as first level and feature name as second level
-            new_columns = []
-            for pair in pairs:
-                for col in output.columns:
-                    new_columns.append((pair, feature_name))
-            
-            output.columns = pd.MultiIndex.from_tuples(new_columns)
+            # Create MultiIndex columns with pairs as first level and the feature class name as second level
+            output.columns = pd.MultiIndex.from_product([output.columns, [self.__class__.__name__]], names=['pair', 'feature'])
         
         return output
     
-    def compute(self, start: Union[str, pd.Timestamp], end: Union[str, pd.Timestamp], add_hash: bool = False, convert_to_multiindex = False):
-        # Convert string inputs to pd.Timestamp if needed
-        if isinstance(start, str):
-            start = pd.Timestamp(start)
-        if isinstance(end, str):
-            end = pd.Timestamp(end)
+    def compute(self, start: Union[str, pd.Timestamp], end: Union[str, pd.Timestamp], add_hash: bool = False, convert_to_multiindex = False,
+                backend: Literal['pandas', 'polars', 'arrow'] = 'pandas'):
+        # Convert string inputs to pd.Timestamp and timezone-naive timestamps to UTC
+        return self.compute_ns(_to_utc_ts(start).value, _to_utc_ts(end).value, add_hash, convert_to_multiindex, backend)
+    
+    def compute_ns(self, start_ns: int, end_ns: int, add_hash: bool = False, convert_to_multiindex = False,
+                   backend: Literal['pandas', 'polars', 'arrow'] = 'pandas'):
+        """
+        Compute the feature for a time range given as int64 nanoseconds since the epoch (UTC).
         
-        # Convert timezone-naive timestamps to UTC
-        if start.tz is None:
-            start = start.tz_localize('UTC')
-        if end.tz is None:
-            end = end.tz_localize('UTC')
+        Skips the string parsing and timezone normalization of compute, for programmatic
+        callers such as tight backtest loops that already work with epoch nanoseconds.
+        """
+        start = pd.Timestamp(start_ns, tz='UTC')
+        end = pd.Timestamp(end_ns, tz='UTC')
         
-        output = self._compute_impl(start, end, self.pairs, **self.kwargs).loc[start:end]
+        output = self._cached_compute_impl(start, end)
         
         # Ensure the DataFrame has MultiIndex columns
         if convert_to_multiindex:
@@ -61,125 +111,308 @@ class Feature:
         if add_hash:
             output = self.add_hash_to_output_columns(output)
         
-        return output
+        return self._to_backend(output, backend)
+    
+    def _cached_compute_impl(self, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        """
+        Run _compute_impl through the in-memory LRU cache and, if Feature.cache_dir is set, the on-disk cache.
+        Cached outputs are returned as shallow copies sharing their values with the cache rather than duplicated
+        on every call, so callers must not modify the returned values in place (replacing columns or the index
+        is fine). With pandas copy-on-write active such writes copy the data first, otherwise they would corrupt
+        the cache. Outputs that are not cached are returned as is.
+        """
+        from .ohlcv import _data_version
+        
+        key = (self.hash, start.value, end.value, _data_version())
+        cache = Feature._compute_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key].copy(deep=False)
+        
+        output = None
+        cache_file = None
+        if Feature.cache_dir is not None:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            
+            cache_file = os.path.join(Feature.cache_dir, f"{self.hash}_{start.value}_{end.value}.parquet")
+            if os.path.exists(cache_file):
+                output = pq.read_table(cache_file).to_pandas()
+        
+        if output is None:
+            output = self._compute_impl(start, end, self.pairs, **self.kwargs)
+            if cache_file is not None:
+                os.makedirs(Feature.cache_dir, exist_ok=True)
+                pq.write_table(pa.Table.from_pandas(output), cache_file)
+        
+        nbytes = self._frame_nbytes(output)
+        cached = Feature.compute_cache_size > 0 and nbytes <= Feature.compute_cache_max_bytes
+        if cached:
+            cache[key] = output
+            Feature._compute_cache_bytes += nbytes
+        while cache and (len(cache) > Feature.compute_cache_size or Feature._compute_cache_bytes > Feature.compute_cache_max_bytes):
+            _, evicted = cache.popitem(last=False)
+            Feature._compute_cache_bytes -= self._frame_nbytes(evicted)
+        
+        return output.copy(deep=False) if cached else output
+    
+    @classmethod
+    def clear_compute_cache(cls):
+        """
+        Clear the in-memory cache of computed feature outputs. The on-disk cache_dir is left untouched.
+        """
+        Feature._compute_cache.clear()
+        Feature._compute_cache_bytes = 0
+    
+    @staticmethod
+    def _frame_nbytes(frame: pd.DataFrame) -> int:
+        """
+        Memory held by the values and index of a dataframe, not counting the objects referenced by object columns.
+        """
+        return int(frame.memory_usage(index=True, deep=False).sum())
+    
+    @staticmethod
+    def compute_many(features: List['Feature'], start: Union[str, pd.Timestamp], end: Union[str, pd.Timestamp], **kwargs) -> List[pd.DataFrame]:
+        """
+        Compute several features over the same time range, reading the OHLCV data they have in common once.
+        
+        Each feature pads the range by its own lookback, so the ranges read are only known while computing.
+        A planning pass computes every feature up to its first OHLCV read and records it, then the union of
+        the recorded ranges and columns is scanned once and the features are computed for real, with each
+        of their reads inside that union sliced out of the scan. Reads outside of it (e.g. a feature's later,
+        differently padded reads) are read on their own like with compute.
+        
+        Args:
+            features: Features to compute
+            start: Start timestamp
+            end: End timestamp
+            **kwargs: Passed on to each feature's compute (add_hash, convert_to_multiindex, backend)
+            
+        Returns:
+            List[pd.DataFrame]: The computed output of each feature, in order
+        """
+        from .ohlcv import OHLCV
+        
+        with OHLCV.shared_scan() as scan:
+            # Features that finish without reading OHLCV data keep the output of the planning pass
+            planned = [scan.plan(lambda feature=feature: feature.compute(start, end, **kwargs)) for feature in features]
+            scan.load()
+            return [output if done else feature.compute(start, end, **kwargs) for feature, (done, output) in zip(features, planned)]
+    
+    @staticmethod
+    def _to_backend(output: pd.DataFrame, backend: str):
+        """
+        Convert the computed pandas output to the requested backend.
+        
+        Args:
+            output: The computed feature dataframe
+            backend: 'pandas' returns the dataframe as is, 'arrow' a pyarrow Table (index kept as a column)
+                     and 'polars' a polars DataFrame built zero-copy from that Table
+        """
+        if backend == 'pandas':
+            return output
+        
+        import pyarrow as pa
+        
+        if backend == 'arrow':
+            return pa.Table.from_pandas(output, preserve_index=True)
+        if backend == 'polars':
+            try:
+                import polars as pl
+            except ImportError:
+                raise ImportError("backend='polars' requires polars, install it with `pip install horcrux[polars]`")
+            return pl.from_arrow(pa.Table.from_pandas(output, preserve_index=True))
+        
+        raise ValueError(f"Unknown backend {backend!r}, expected one of 'pandas', 'polars', 'arrow'")
     
     def add_hash_to_output_columns(self, output: pd.DataFrame) -> pd.DataFrame:
-        # Get the current column names
-        new_columns = []
-        
-        for pair, feature_name in output.columns:
-            # Check if the feature name already has a hash appended
-            # Format is FEATURENAME$HASH where hash is 10 characters
-            # So we check if the 11th character from the right is '$'
-            if len(feature_name) >= 11 and feature_name[-11] == '$':
-                # Hash already present, keep the original name
-                new_columns.append((pair, feature_name))
-            else:
-                # No hash present, append our hash
-                new_feature_name = f"{feature_name}${self.hash}"
-                new_columns.append((pair, new_feature_name))
+        # Only the feature name level changes, so rename its unique values instead of rebuilding every column tuple.
+        # Dropping unused levels first keeps the renamed level from colliding with stale entries
+        columns = output.columns.remove_unused_levels()
+        feature_names = columns.levels[1]
         
-        # Update the column names
-        output.columns = pd.MultiIndex.from_tuples(new_columns)
+        # Keep names that already have a hash appended, append our hash to the others. A plain slice
+        # comparison is a vectorized string op, unlike a regex match
+        has_hash = feature_names.str.slice(-HASH_LENGTH - 1, -HASH_LENGTH) == "$"
+        new_feature_names = feature_names.where(has_hash, feature_names + f"${self.hash}")
+        
+        # Update the column names, set_levels keeps the level names
+        output.columns = columns.set_levels(new_feature_names, level=1)
         
         return output
     
     def save_to(self, start: Union[str, pd.Timestamp], end: Union[str, pd.Timestamp], file_location: str) -> pd.DataFrame:
         """
-        Compute the feature and save it to a parquet file optimized for time-based queries.
+        Compute the feature and save it to parquet, optimized for time-based queries.
+        
+        If file_location is an existing file or ends with .parquet, everything is kept in that single
+        parquet file, which is read, merged with the new data and rewritten. Otherwise file_location is a
+        directory holding one file per month named YYYY-MM.parquet, e.g. file_location/2024-01.parquet, and only
+        the months overlapping [start, end] are read, merged and rewritten. No partition key is stored in the
+        data, so both layouts read back with pd.read_parquet(file_location).
         
         Args:
             start: Start timestamp
             end: End timestamp  
-            pairs: List of pairs to compute
-            file_location: Path to the parquet file
+            file_location: Path to the parquet file or the monthly dataset directory
             
         Returns:
             pd.DataFrame: The computed feature dataframe
         """
-        import os
-        import pyarrow as pa
-        import pyarrow.parquet as pq
-        
         # Compute the feature
         output = self.compute(start, end, add_hash=True, convert_to_multiindex=True)
         
-        # Ensure the output is sorted by index (timestamp) for better query performance
-        output = output.sort_index()
+        # Ensure the output is sorted by index (timestamp) for better query performance, most features already are
+        if not output.index.is_monotonic_increasing:
+            output = output.sort_index()
+        
+        if os.path.isfile(file_location) or file_location.endswith(".parquet"):
+            directory = os.path.dirname(file_location)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._merge_into_parquet(output, file_location)
+            return output
         
-        # Check if the parquet file exists
+        os.makedirs(file_location, exist_ok=True)
+        for month, new_rows in output.groupby(output.index.strftime("%Y-%m")):
+            self._merge_into_parquet(new_rows, os.path.join(file_location, f"{month}.parquet"))
+        
+        return output
+    
+    def _merge_into_parquet(self, new_rows: pd.DataFrame, file_location: str):
+        """
+        Merge sorted new rows into the parquet file, creating it if needed. For timestamps present in both,
+        the new rows are kept.
+        """
+        import pyarrow.parquet as pq
+        
+        # Check if the file already exists
         if os.path.exists(file_location):
-            # Load existing data
-            existing_df = pd.read_parquet(file_location)
-            
-            # Merge with new data
-            # We'll use pd.concat and remove duplicates, keeping the newer data
-            combined = pd.concat([existing_df, output])
-            
-            # Remove duplicate rows based on index (timestamp) and columns
-            # Keep last occurrence (the newer data)
-            combined = combined[~combined.index.duplicated(keep='last')]
+            # Load the existing data, releasing the arrow buffers while converting to keep peak memory down
+            existing_df = pq.ParquetFile(file_location).read().to_pandas(self_destruct=True, split_blocks=True, use_threads=True)
             
-            # Sort by index
-            combined = combined.sort_index()
-            
-            # Save the combined data with optimization
-            table = pa.Table.from_pandas(combined)
-            pq.write_table(
-                table, 
-                file_location,
-                compression='snappy',  # Fast compression for read performance
-                row_group_size=10000,  # Smaller row groups for efficient month-by-month reading
-                use_dictionary=True,   # Dictionary encoding for repeated values
-                data_page_size=1024*1024,  # 1MB data pages
-                version='2.6'  # Latest parquet version for better performance
-            )
+            # Both sides are sorted, so only the existing rows that aren't overwritten are kept and a sort is only
+            # needed when they interleave with the new ones
+            kept_rows = existing_df[~existing_df.index.isin(new_rows.index)]
+            if len(kept_rows) == 0:
+                combined = new_rows
+            else:
+                combined = pd.concat([kept_rows, new_rows])
+                if not combined.index.is_monotonic_increasing:
+                    combined = combined.sort_index()
         else:
-            # Create directory if it doesn't exist
-            os.makedirs(os.path.dirname(file_location), exist_ok=True)
-            
-            # Save the output directly with optimization
-            table = pa.Table.from_pandas(output)
-            pq.write_table(
-                table, 
-                file_location,
-                compression='snappy',  # Fast compression for read performance
-                row_group_size=10000,  # Smaller row groups for efficient month-by-month reading
-                use_dictionary=True,   # Dictionary encoding for repeated values
-                data_page_size=1024*1024,  # 1MB data pages
-                version='2.6'  # Latest parquet version for better performance
-            )
+            combined = new_rows
         
-        return output
+        # Save the data with optimization
+        self._write_parquet(combined, file_location)
+    
+    def _write_parquet(self, frame: pd.DataFrame, file_location: str, row_group_size: int = ROW_GROUP_SIZE):
+        """
+        Write the dataframe to a parquet file, streaming it as record batches of row_group_size rows
+        so the whole frame is never materialized a second time as an arrow table.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        schema = pa.Schema.from_pandas(frame, preserve_index=True)
+        with pq.ParquetWriter(
+            file_location,
+            schema,
+            compression='snappy',  # Fast compression for read performance
+            use_dictionary=True,   # Dictionary encoding for repeated values
+            data_page_size=2*1024*1024,  # 2MB data pages
+            version='2.6',  # Latest parquet version for better performance
+            write_statistics=True,  # Row group min/max statistics for predicate pushdown
+            sorting_columns=self._index_sorting_columns(schema)  # Lets readers skip re-sorting by timestamp
+        ) as writer:
+            # Every batch becomes one row group
+            for offset in range(0, len(frame), row_group_size):
+                # Not passing the schema here: pyarrow can't map the stringified (pair, feature) field names back to
+                # MultiIndex columns, every slice converts to the same schema anyway
+                batch = pa.RecordBatch.from_pandas(frame.iloc[offset:offset + row_group_size], preserve_index=True)
+                writer.write_batch(batch, row_group_size=row_group_size)
+    
+    @staticmethod
+    def _index_sorting_columns(schema):
+        """
+        Return the parquet sorting columns declaring a table with this schema sorted by its (timestamp) index column.
+        """
+        import pyarrow.parquet as pq
+        
+        index_columns = (schema.pandas_metadata or {}).get("index_columns", [])
+        if index_columns and isinstance(index_columns[0], str):
+            return [pq.SortingColumn(schema.get_field_index(index_columns[0]))]
+        return None
     
     @abstractmethod
     def _compute_impl(self, start: pd.Timestamp, end: pd.Timestamp, pairs: List[str], **kwargs):
+        """
+        Compute the feature for the given time range and pairs.
+        
+        Contract: the returned DataFrame must contain exactly the rows in [start, end]. Features
+        that need extra history (rolling windows, offsets) must clip their padded result
+        themselves, compute does not re-slice the output.
+        """
         raise NotImplementedError
     
-    #TODO hashing does not support other features yet, only valid json objects like str, float and bool.
-    #Need to write a custom serialization function that correctly serializes feature objects and also things like pd.DateTime etc
+    @staticmethod
+    def _hash_default(obj):
+        """
+        Serialize objects orjson can't handle natively: features by their own hash, anything else by str().
+        """
+        if isinstance(obj, Feature):
+            return obj.hash
+        return str(obj)
+    
+    #TODO hashing serializes features by their hash and falls back to str() for other non json types,
+    #classes and things like pd.DateTime should get a dedicated serialization
     def __compute_hash(self):
+        # inspect.getsource reads and tokenizes the source file, which dominates the cost, so only do it once per class
+        cls = type(self)
+        class_digest = Feature._class_source_hash.get(cls)
+        if class_digest is None:
+            class_digest = hashlib.blake2b(inspect.getsource(cls).encode(), digest_size=32).digest()
+            Feature._class_source_hash[cls] = class_digest
+        
         identifier = {
-            "code": inspect.getsource(self.__class__),
             "pairs": self.pairs,
             "kwargs": self.kwargs
         }
-        identifier_json = json.dumps(identifier, sort_keys = True, default = str)
-        hash_bytes = hashlib.sha256(identifier_json.encode()).digest()
+        identifier_json = orjson.dumps(
+            identifier,
+            default = self._hash_default,
+            option = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        )
+        # Combine the class digest with the (pairs, kwargs) identifier in a single hash
+        hasher = hashlib.blake2b(class_digest, digest_size=32)
+        hasher.update(identifier_json)
+        hash_bytes = hasher.digest()
         compact_hash_encoding = base64.urlsafe_b64encode(hash_bytes).decode()
         return compact_hash_encoding
     
     def test_leak(self):
+        """
+        Compare the feature computed over the full range with the same range computed in chunks.
+        Non-zero values mean the output depends on the window it was computed over. The chunked
+        computes are what is being tested, so they can't be sliced out of the full range result.
+        """
         full_start = pd.Timestamp("2024-01-01", tz="UTC")
         step = pd.Timedelta(days=30)
         n = 10
-        chunks = []
-        for i in range(0, n):
+        full_df = self.compute(full_start, full_start + n*step)
+        full_values = full_df.to_numpy(dtype=np.float64)
+        
+        # Write the differences straight into one preallocated array instead of concatenating the chunks,
+        # rows no chunk covers stay NaN
+        diff = np.full(full_values.shape, np.nan)
+        # Consecutive chunks share their boundary timestamp, going backwards lets the earlier chunk's value win
+        for i in reversed(range(0, n)):
             start = full_start + i*step
             end = full_start + (i+1)*step
             chunk = self.compute(start, end)
-            chunks.append(chunk)
+            positions = full_df.index.get_indexer(chunk.index)
+            found = positions >= 0
+            chunk_values = chunk.reindex(columns=full_df.columns).to_numpy(dtype=np.float64)
+            diff[positions[found]] = full_values[positions[found]] - chunk_values[found]
         
-        chunks_df = pd.concat(chunks)
-        full_df = self.compute(full_start, full_start + n*step)
-        return full_df - chunks_df
\ No newline at end of file
+        return pd.DataFrame(diff, index=full_df.index, columns=full_df.columns)
\ No newline at end of file
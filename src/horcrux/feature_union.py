@@ -1,30 +1,42 @@
-from .feature import Feature
+from .feature import Feature, _hstack_frames
 import pandas as pd
+import numpy as np
 from typing import List, Union
 import os
 import logging
+import multiprocessing
 import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
 class FUnion(Feature):
     def _compute_impl(self, start: pd.Timestamp, end: pd.Timestamp, pairs: List[str], features: List[Feature], add_hash_to_features = True):
-        computed_features = [feature.compute(start, end, pairs, add_hash = add_hash_to_features, convert_to_multiindex = True) for feature in features]
+        computed_features = [feature.compute(start, end, add_hash = add_hash_to_features, convert_to_multiindex = True) for feature in features]
         
-        return pd.concat(computed_features, axis = 1)
+        return _hstack_frames(computed_features)
     
     def save_to(self, start: Union[str, pd.Timestamp], end: Union[str, pd.Timestamp], 
                 pairs: Union[str, List[str]], file_directory: str, 
-                log_dir: Union[str, None] = None) -> None:
+                log_dir: Union[str, None] = None, max_workers: Union[int, None] = None) -> None:
         """
-        Save each feature to its own parquet file with comprehensive logging.
+        Save each feature to its own parquet dataset with comprehensive logging. Each feature is saved
+        with Feature.save_to to file_directory/<hash>, or to file_directory/<hash>.parquet if that file exists.
+        
+        By default the features are saved one after the other in the calling process. With max_workers > 1
+        they are computed and saved in parallel worker processes, each running numba with
+        os.cpu_count() // max_workers threads, and logged in the calling process as they complete.
+        The workers are spawned, so the features must be picklable and importable by the workers
+        (not defined in a notebook or in __main__), and scripts have to call save_to under an
+        `if __name__ == "__main__":` guard.
         
         Args:
             start: Start timestamp
             end: End timestamp
             pairs: List of pairs to compute
-            file_directory: Directory where feature parquet files will be saved
+            file_directory: Directory where feature parquet datasets will be saved
             log_dir: Directory for log files (defaults to file_directory)
+            max_workers: Number of worker processes, None or 1 (the default) saves the features serially in this process
         """
         # Setup logging
         if log_dir is None:
@@ -65,67 +77,126 @@ class FUnion(Feature):
         # Get features from kwargs
         features = self.kwargs.get('features', [])
         
-        # Process each feature
-        for i, feature in enumerate(features):
-            feature_start_time = time.time()
-            
-            try:
-                # Log feature information
-                logger.info(f"Processing feature {i+1}/{len(features)}")
-                logger.info(f"Feature class: {feature.__class__.__name__}")
-                logger.info(f"Feature args: {feature.args}")
-                logger.info(f"Feature kwargs: {feature.kwargs}")
-                logger.info(f"Feature hash: {feature.hash}")
-                
-                # Create feature-specific file location with just the hash
-                feature_file_location = os.path.join(file_directory, f"{feature.hash}.parquet")
-                
-                logger.info(f"Saving to: {feature_file_location}")
-                
-                # Call save_to on the feature
-                output_df = feature.save_to(start, end, pairs, feature_file_location)
-                
-                # Calculate duration
-                duration = time.time() - feature_start_time
-                logger.info(f"Feature computation took {duration:.2f} seconds")
-                
-                # Check for NaN values
-                nan_count = output_df.isna().sum().sum()
-                if nan_count > 0:
-                    logger.warning(f"Found {nan_count} NaN values in output!")
-                    
-                    # Log detailed NaN information
-                    nan_summary = output_df.isna().sum()
-                    nan_cols = nan_summary[nan_summary > 0]
-                    if len(nan_cols) > 0:
-                        logger.warning("NaN values by column:")
-                        for col, count in nan_cols.items():
-                            logger.warning(f"  {col}: {count} NaN values")
-                else:
-                    logger.info("No NaN values found in output")
-                
-                # Log output shape
-                logger.info(f"Output shape: {output_df.shape}")
-                logger.info(f"Successfully saved feature {i+1}/{len(features)}")
+        # Create feature-specific monthly dataset directories with just the hash. Features saved by
+        # earlier versions as a single hash.parquet file keep being merged into that file
+        locations = []
+        for feature in features:
+            feature_file_location = os.path.join(file_directory, f"{feature.hash}.parquet")
+            if not os.path.isfile(feature_file_location):
+                feature_file_location = os.path.join(file_directory, feature.hash)
+            locations.append(feature_file_location)
+        
+        if max_workers is None or max_workers <= 1:
+            # Save the features one after the other in this process
+            for i, feature in enumerate(features):
+                self._log_submitted(logger, i, feature, features, locations[i])
+                self._log_saved(logger, i, feature, features, lambda i=i, feature=feature: _save_one(feature, start, end, locations[i]))
+        else:
+            # Spawn rather than fork the workers, forking a process that already started numba's parallel
+            # thread pool can deadlock. Every worker runs numba's parallel kernels with its share of the cores
+            threads_per_worker = max(1, (os.cpu_count() or 1) // max_workers)
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker, initargs=(threads_per_worker,)) as executor:
+                futures = {}
+                for i, feature in enumerate(features):
+                    self._log_submitted(logger, i, feature, features, locations[i])
+                    futures[executor.submit(_save_one, feature, start, end, locations[i])] = (i, feature)
                 
-            except Exception as e:
-                # Log the error
-                duration = time.time() - feature_start_time
-                logger.error(f"Error processing feature {i+1}/{len(features)} after {duration:.2f} seconds")
-                logger.error(f"Feature class: {feature.__class__.__name__}")
-                logger.error(f"Feature hash: {feature.hash}")
-                logger.error(f"Error type: {type(e).__name__}")
-                logger.error(f"Error message: {str(e)}")
-                logger.error(f"Traceback:\n{traceback.format_exc()}")
+                logger.info("-" * 80)
                 
-                # Continue with next feature
-                logger.info("Continuing with next feature...")
-            
-            logger.info("-" * 80)
+                # Process each feature as it completes
+                for future in as_completed(futures):
+                    i, feature = futures[future]
+                    self._log_saved(logger, i, feature, features, future.result)
         
         logger.info("FUnion save_to process completed")
         
         # Close the file handler
         file_handler.close()
         logger.removeHandler(file_handler)
-        
\ No newline at end of file
+
+    
+    @staticmethod
+    def _log_submitted(logger: logging.Logger, i: int, feature: Feature, features: List[Feature], file_location: str):
+        """
+        Log the feature about to be saved.
+        """
+        logger.info(f"Processing feature {i+1}/{len(features)}")
+        logger.info(f"Feature class: {feature.__class__.__name__}")
+        logger.info(f"Feature kwargs: {feature.kwargs}")
+        logger.info(f"Feature hash: {feature.hash}")
+        logger.info(f"Saving to: {file_location}")
+    
+    @staticmethod
+    def _log_saved(logger: logging.Logger, i: int, feature: Feature, features: List[Feature], get_summary):
+        """
+        Log the outcome of saving a feature, get_summary returns the _save_one summary or raises its error.
+        """
+        try:
+            summary = get_summary()
+            
+            logger.info(f"Feature {i+1}/{len(features)} ({feature.__class__.__name__}, hash {feature.hash}) completed")
+            logger.info(f"Feature computation took {summary['duration']:.2f} seconds")
+            
+            # Check for NaN values
+            if summary['nan_count'] > 0:
+                logger.warning(f"Found {summary['nan_count']} NaN values in output!")
+                
+                # Log detailed NaN information
+                if len(summary['nan_columns']) > 0:
+                    logger.warning("NaN values by column:")
+                    for col, count in summary['nan_columns']:
+                        logger.warning(f"  {col}: {count} NaN values")
+            else:
+                logger.info("No NaN values found in output")
+            
+            # Log output shape
+            logger.info(f"Output shape: {summary['shape']}")
+            logger.info(f"Successfully saved feature {i+1}/{len(features)}")
+            
+        except Exception as e:
+            # Log the error, with worker processes the traceback includes the one raised in the worker
+            logger.error(f"Error processing feature {i+1}/{len(features)}")
+            logger.error(f"Feature class: {feature.__class__.__name__}")
+            logger.error(f"Feature hash: {feature.hash}")
+            logger.error(f"Error type: {type(e).__name__}")
+            logger.error(f"Error message: {str(e)}")
+            logger.error(f"Traceback:\n{traceback.format_exc()}")
+            
+            # Continue with next feature
+            logger.info("Continuing with next feature...")
+        
+        logger.info("-" * 80)
+
+
+def _init_worker(num_threads: int):
+    """
+    Initialize a FUnion.save_to worker process, capping numba's threads so the workers together don't oversubscribe the cores.
+    """
+    import numba
+    
+    numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+
+
+def _save_one(feature: Feature, start: Union[str, pd.Timestamp], end: Union[str, pd.Timestamp], file_location: str) -> dict:
+    """
+    Save a single feature, run in a FUnion.save_to worker process. Only a small summary is sent
+    back to be logged by the parent, so neither the output frame nor the logger cross processes.
+    """
+    feature_start_time = time.time()
+    
+    # Call save_to on the feature
+    output_df = feature.save_to(start, end, file_location)
+    
+    # Count NaNs with a single pass over the values instead of pandas reductions
+    nan_mask = np.isnan(output_df.to_numpy(dtype=np.float64, na_value=np.nan))
+    column_counts = nan_mask.sum(axis=0)
+    nan_count = int(column_counts.sum())
+    nan_columns = [(output_df.columns[j], int(column_counts[j])) for j in np.flatnonzero(column_counts)]
+    
+    return {
+        "duration": time.time() - feature_start_time,
+        "nan_count": nan_count,
+        "nan_columns": nan_columns,
+        "shape": output_df.shape,
+    }
@@ -5,5 +5,8 @@ import numpy as np
 
 class FLog(Feature):
     def _compute_impl(self, start: pd.Timestamp, end: pd.Timestamp, pairs: List[str], base_feature: Feature):
-        return np.log(base_feature.compute(start, end, pairs))
-        
\ No newline at end of file
+        # compute shares its values with the cached output, so the log is written to one new array
+        # that is wrapped without a further copy. The dtype of the base feature (e.g. float32 OHLCV) is kept
+        data = base_feature.compute(start, end)
+        values = np.log(data.to_numpy())
+        return pd.DataFrame(values, index = data.index, columns = data.columns, copy = False)
@@ -1,23 +1,88 @@
 from .feature import Feature
 import pandas as pd
-from typing import List
+from typing import Dict, List, Tuple, Union
 import numpy as np
+import functools
+import numba
 from .log import FLog
 from .ohlcv import OHLCV
 
+# pd.Timedelta of each offset in minutes, shared by the FLogReturns of a parameter grid
+_OFFSET_TIMEDELTAS: Dict[int, pd.Timedelta] = {}
+
+@functools.lru_cache(maxsize=32)
+def _log_close(pairs: Tuple[str, ...], dtype: Union[str, None] = None) -> FLog:
+    """
+    Log close price feature shared by every FLogReturns over the same pairs, so it is constructed
+    (and hashed) once per process and its output is reused through the Feature.compute cache.
+    """
+    # Only pass dtype when set so the default feature keeps the same hash
+    ohlcv_kwargs = {} if dtype is None else {"dtype": dtype}
+    return FLog(list(pairs), base_feature = OHLCV(list(pairs), fields = ["close"], **ohlcv_kwargs))
+
+@numba.njit(parallel=True, cache=True)
+def diff_shift(vals, k, out):
+    """
+    Numba-compiled backward difference out[i] = vals[i] - vals[i-k] of every column, the first k rows are NaN.
+    
+    Args:
+        vals: 2D numpy array of shape (N, K), ideally Fortran ordered so each column is contiguous
+        k: Non-negative shift in rows
+        out: Preallocated 2D numpy array of shape (N, K) the differences are written to
+    """
+    N, K = vals.shape
+    k = min(k, N)
+    for j in numba.prange(K):
+        for i in range(k):
+            out[i, j] = np.nan
+        for i in range(k, N):
+            out[i, j] = vals[i, j] - vals[i - k, j]
+
+
+@numba.njit(parallel=True, cache=True)
+def diff_shift_forward(vals, k, out):
+    """
+    Numba-compiled forward difference out[i] = vals[i+k] - vals[i] of every column, the last k rows are NaN.
+    
+    Args:
+        vals: 2D numpy array of shape (N, K), ideally Fortran ordered so each column is contiguous
+        k: Non-negative shift in rows
+        out: Preallocated 2D numpy array of shape (N, K) the differences are written to
+    """
+    N, K = vals.shape
+    k = min(k, N)
+    for j in numba.prange(K):
+        for i in range(N - k):
+            out[i, j] = vals[i + k, j] - vals[i, j]
+        for i in range(N - k, N):
+            out[i, j] = np.nan
+
+
 class FLogReturns(Feature):
-    def _compute_impl(self, start: pd.Timestamp, end: pd.Timestamp, pairs: List[str], offset = 15):
-        abs_offset = np.abs(offset)
-        offset_timedelta = pd.Timedelta(minutes = abs_offset)
-        result = None
+    def _compute_impl(self, start: pd.Timestamp, end: pd.Timestamp, pairs: List[str], offset = 15, dtype: str = None,
+                      base_feature: Feature = None):
+        abs_offset = -offset if offset < 0 else offset
+        offset_timedelta = _OFFSET_TIMEDELTAS.get(abs_offset)
+        if offset_timedelta is None:
+            offset_timedelta = _OFFSET_TIMEDELTAS[abs_offset] = pd.Timedelta(minutes = abs_offset)
+        # Log prices (one column per pair) to take the returns of, callers can share one instance across all offsets. Defaults to
+        # the process wide log close feature of the pairs
+        log_close = base_feature if base_feature is not None else _log_close(tuple(pairs), dtype)
         #if offset is positive then that means we are looking into the past so we are not data leaking
         if offset >= 0:
-            log_price = FLog(OHLCV(fields = ["close"])).compute(start- offset_timedelta, end, pairs)
-            result = (log_price - log_price.shift(abs_offset))
+            log_price = log_close.compute(start- offset_timedelta, end)
         #if offset is negative then that means we are looking into the future so we are data leaking
-        if offset < 0:
-            log_price = FLog(OHLCV(fields = ["close"])).compute(start, end + offset_timedelta, pairs)
-            result = (log_price.shift(-abs_offset) - log_price)
+        else:
+            log_price = log_close.compute(start, end + offset_timedelta)
+        
+        # Difference the underlying array in one fused pass rather than through DataFrame.shift and an aligned subtraction
+        values = np.asfortranarray(log_price.to_numpy())
+        diff = np.empty(values.shape, dtype = values.dtype, order = 'F')
+        if offset >= 0:
+            diff_shift(values, abs_offset, diff)
+        else:
+            diff_shift_forward(values, abs_offset, diff)
+        result = pd.DataFrame(diff, index = log_price.index, columns = log_price.columns, copy = False)
         
         # Extract pair names from the existing MultiIndex columns
         # result.columns is a MultiIndex with (pair, 'close') structure
@@ -29,5 +94,6 @@ class FLogReturns(Feature):
             # Fallback for non-MultiIndex columns (shouldn't happen with current setup)
             result.columns = pd.MultiIndex.from_product([result.columns, ["log_return"]], names=['pair', 'feature'])
         
-        return result
+        # Clip the offset padding, compute expects exactly [start, end]
+        return result.loc[start:end]
         
\ No newline at end of file
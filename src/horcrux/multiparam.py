@@ -1,12 +1,12 @@
-from .feature import Feature
+from .feature import Feature, _hstack_frames
 import pandas as pd
 from typing import List
 
 class FMultiParam(Feature):
     def _compute_impl(self, start: pd.Timestamp, end: pd.Timestamp, pairs: List[str], base_feature: Feature, params_list: List[dict]):
-        multiparam_features_computed = [base_feature(**params).compute(start, end, pairs, add_hash = True) for params in params_list]
+        multiparam_features_computed = [base_feature(pairs, **params).compute(start, end, add_hash = True) for params in params_list]
         
-        return pd.concat(multiparam_features_computed, axis = 1)
+        return _hstack_frames(multiparam_features_computed)
     
     def get_features(self):
         """
@@ -21,4 +21,4 @@ class FMultiParam(Feature):
         if base_feature is None:
             raise ValueError("base_feature must be provided in kwargs")
         
-        return [base_feature(**params) for params in params_list]
\ No newline at end of file
+        return [base_feature(self.pairs, **params) for params in params_list]
\ No newline at end of file
@@ -1,62 +1,410 @@
+import ast
+import functools
+import os
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 import toml
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, List, NamedTuple, Tuple, Union
 from pydantic import BaseModel
 from .feature import Feature
 
+CONFIG_PATH = "~/.config/horcrux/horcrux_config.toml"
+
+# Hive partitioning of a repartitioned OHLCV dataset directory (see repartition_ohlcv)
+DATE_PARTITION_COLUMN = "date"
+DATE_PARTITIONING = ds.partitioning(pa.schema([(DATE_PARTITION_COLUMN, pa.date32())]), flavor="hive")
+
+# Scanner settings for the parquet reads
+SCAN_BATCH_SIZE = 65536
+SCAN_BATCH_READAHEAD = 16
+SCAN_FRAGMENT_READAHEAD = 4
+
+@functools.lru_cache(maxsize=None)
+def _load_config(config_path: str = CONFIG_PATH) -> dict:
+    """
+    Load and cache the horcrux TOML config.
+    """
+    return toml.load(Path(config_path).expanduser())
+
+def _data_version() -> Union[Tuple[str, int], None]:
+    """
+    Identify the OHLCV data features are computed from by the configured path and its modification time
+    in nanoseconds, or None when there is no readable config or data. For a partitioned directory this is
+    the directory's mtime, which changes when files are added, removed or replaced but not when a file in
+    it is rewritten in place.
+    """
+    try:
+        ohlcv_path = str(Path(_load_config()["ohlcv_path"]).expanduser())
+        return ohlcv_path, os.stat(ohlcv_path).st_mtime_ns
+    except (OSError, KeyError, ValueError):
+        return None
+
+@functools.lru_cache(maxsize=4)
+def _open_dataset(path: str) -> ds.Dataset:
+    """
+    Open and cache a parquet dataset handle keyed by path.
+    The footer metadata (schema and row group statistics) is parsed only once per path.
+    A directory is opened as a date partitioned hive dataset.
+    """
+    if Path(path).is_dir():
+        return ds.dataset(path, format="parquet", partitioning=DATE_PARTITIONING)
+    return ds.dataset(path, format="parquet")
+
+@functools.lru_cache(maxsize=16)
+def _is_sorted_by(file_path: str, column: str) -> bool:
+    """
+    Check whether the parquet footer declares the file sorted (ascending) by the given column.
+    """
+    metadata = pq.read_metadata(file_path)
+    if metadata.num_row_groups == 0:
+        return False
+    column_index = metadata.schema.to_arrow_schema().get_field_index(column)
+    sorting_columns = metadata.row_group(0).sorting_columns or ()
+    return any(sc.column_index == column_index and not sc.descending for sc in sorting_columns)
+
+@functools.lru_cache(maxsize=4)
+def _dataset_layout(path: str) -> Tuple[str, Dict[str, List[Tuple[str, str]]], bool]:
+    """
+    Flatten the dataset schema once per path into the timestamp column name, a mapping of
+    pair -> [(field, parquet column name)] used to resolve column projections and whether
+    the dataset is date partitioned.
+    """
+    schema = _open_dataset(path).schema
+    index_column = OHLCV._index_column(schema)
+    partitioned = Path(path).is_dir()
+    pair_columns = {}
+    for name in schema.names:
+        if name == index_column or (partitioned and name == DATE_PARTITION_COLUMN):
+            continue
+        key = OHLCV._column_key(name)
+        field = key[1] if len(key) > 1 else None
+        pair_columns.setdefault(key[0], []).append((field, name))
+    return index_column, pair_columns, partitioned
+
+def _cast_float_columns(table: pa.Table, dtype: str) -> pa.Table:
+    """
+    Cast all floating point columns of the table to the given numpy dtype (e.g. 'float32').
+    """
+    target_type = pa.from_numpy_dtype(np.dtype(dtype))
+    fields = [
+        pa.field(field.name, target_type, field.nullable, field.metadata) if pa.types.is_floating(field.type) else field
+        for field in table.schema
+    ]
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+def repartition_ohlcv(source_path: str, base_dir: str, max_rows_per_file: int = 1_000_000, dtype: str = None) -> None:
+    """
+    One-time rewrite of a single-file OHLCV parquet into a hive dataset partitioned by UTC date,
+    e.g. base_dir/date=2024-01-01/part-0.parquet. Pointing ohlcv_path at base_dir lets queries
+    skip whole files by their partition value before looking at any row group statistics.
+
+    Args:
+        source_path: Path to the single-file OHLCV parquet
+        base_dir: Directory to write the partitioned dataset to
+        max_rows_per_file: Maximum number of rows per written file
+        dtype: Optional dtype to store the float columns as, 'float32' halves the bytes read per query
+    """
+    table = pq.read_table(source_path)
+    if dtype is not None:
+        table = _cast_float_columns(table, dtype)
+    index_column = OHLCV._index_column(table.schema)
+
+    # Partition on the calendar date of the (UTC) timestamp index
+    table = table.append_column(DATE_PARTITION_COLUMN, pc.cast(table.column(index_column), pa.date32()))
+
+    ds.write_dataset(
+        table,
+        base_dir,
+        format="parquet",
+        partitioning=DATE_PARTITIONING,
+        max_rows_per_file=max_rows_per_file,
+        max_rows_per_group=max_rows_per_file,
+        existing_data_behavior="delete_matching",
+    )
+
+class _ScanPlanned(BaseException):
+    """
+    Raised by an OHLCV read during the planning pass of a shared scan to stop the feature computing it.
+    Derived from BaseException so a feature's own `except Exception` doesn't swallow it and carry on without the data.
+    """
+
+
+class _Scan(NamedTuple):
+    """
+    One read of a shared scan covering [start, end] and the given (pair, field) column keys.
+    """
+    start: pd.Timestamp
+    end: pd.Timestamp
+    column_keys: set
+    frame: pd.DataFrame
+
+
+class _SharedScan:
+    """
+    State of an OHLCV.shared_scan scope.
+    """
+    def __init__(self):
+        # Whether OHLCV reads are recorded (planning pass) rather than served
+        self.recording = True
+        # (path, dtype, start, end, columns, column_keys) of every read recorded by the planning pass
+        self.requests = []
+        # _Scan of each (path, dtype) read by load()
+        self.scans = {}
+
+    def plan(self, compute):
+        """
+        Run compute() in the planning pass. Returns (True, result) if it finished without reading OHLCV
+        data, (False, None) if it was interrupted by its first read, which is recorded.
+        """
+        try:
+            return True, compute()
+        except _ScanPlanned:
+            return False, None
+
+    def load(self):
+        """
+        End the planning pass, reading the union of the recorded requests.
+        """
+        self.recording = False
+        if self.requests:
+            OHLCV._load_shared_scan(self)
+
+
 class OHLCV(Feature):
-    # Class variable to cache the entire OHLCV dataset
-    ohlcv_data = None
-    
-    def _compute_impl(self, start: pd.Timestamp, end: pd.Timestamp, pairs: List[str]) -> pd.DataFrame:
+    # Class variable caching fully loaded OHLCV frames keyed by (path, dtype), only used with preload=True
+    preloaded_data = {}
+    # State of the active shared_scan scope, None outside of one
+    _shared_scan = None
+
+    def _compute_impl(self, start: pd.Timestamp, end: pd.Timestamp, pairs: List[str], fields: List[str] = None, dtype: str = None,
+                      preload: bool = False) -> pd.DataFrame:
         """
         Calculate OHLCV data for given time range and pairs.
-        
+
+        By default only the row groups overlapping [start, end] and the column chunks of the
+        requested pairs/fields are read from the parquet file. With preload=True the whole file
+        is loaded into memory once and every call slices it, which is faster for many repeated
+        queries on a warm cache at the cost of holding the full dataset in memory.
+
         Args:
             start: Start timestamp (inclusive)
-            end: End timestamp (inclusive) 
+            end: End timestamp (inclusive)
             pairs: List of trading pairs to retrieve
-            
+            fields: Optional list of ohlcv fields to retrieve (e.g. ["close"]), defaults to all fields
+            dtype: Optional dtype to cast the float columns to (e.g. 'float32'), defaults to the stored dtype
+            preload: Load the entire file once into a class level cache and slice it instead of a filtered read
+
         Returns:
             MultiIndex DataFrame with (pair, ohlcv) as columns and timestamp as index
         """
-            
+
         #Handle incorrect start/end timestamps
         if start > end:
             raise ValueError("start timestamp must be before or equal to end timestamp")
-        
-        # Load data into class variable if not already loaded
-        if OHLCV.ohlcv_data is None:
-            self._load_ohlcv_data()
-        
-        return OHLCV.ohlcv_data.loc[start:end][pairs].ffill()
-    
-    def _load_ohlcv_data(self):
-        """
-        Load the entire OHLCV parquet file into the class variable.
-        This is called only once when the data is first needed.
+
+        ohlcv_path, dataset = self._load_ohlcv_data()
+        index_column, pair_columns, partitioned = _dataset_layout(ohlcv_path)
+
+        # Resolve the requested pairs/fields to the flat parquet column names, so the scanner never decodes the others
+        field_set = None if fields is None else set(fields)
+        columns = []
+        column_keys = []
+        for pair in dict.fromkeys(pairs):
+            for field, name in pair_columns.get(pair, []):
+                if field_set is None or field is None or field in field_set:
+                    columns.append(name)
+                    column_keys.append(pair if field is None else (pair, field))
+
+        if preload:
+            cache_key = (ohlcv_path, dtype)
+            if cache_key not in OHLCV.preloaded_data:
+                OHLCV.preloaded_data[cache_key] = self._read(dataset, index_column, partitioned, None, None, dtype)
+            return OHLCV.preloaded_data[cache_key].loc[start:end, column_keys].ffill()
+
+        shared = OHLCV._shared_scan
+        if shared is not None:
+            if shared.recording:
+                # Planning pass of a shared scan, note what is read and stop the feature's computation here
+                shared.requests.append((ohlcv_path, dtype, start, end, columns, column_keys))
+                raise _ScanPlanned()
+            scan = shared.scans.get((ohlcv_path, dtype))
+            if scan is not None and scan.start <= start and end <= scan.end and scan.column_keys.issuperset(column_keys):
+                # Slicing the shared scan gives the same frame as reading [start, end] directly
+                return scan.frame.loc[start:end, column_keys].ffill()
+
+        expr = self._range_filter(dataset, index_column, partitioned, start, end)
+        return self._read(dataset, index_column, partitioned, [index_column] + columns, expr, dtype).ffill()
+
+    @staticmethod
+    def _range_filter(dataset: ds.Dataset, index_column: str, partitioned: bool, start: pd.Timestamp, end: pd.Timestamp) -> pc.Expression:
+        """
+        Return the scan filter selecting the rows in [start, end].
+        """
+        # Predicate pushdown on the timestamp column so only matching row groups are decoded
+        timestamp_type = dataset.schema.field(index_column).type
+        timestamp = pc.field(index_column)
+        expr = (timestamp >= OHLCV._timestamp_scalar(start, timestamp_type)) & (timestamp <= OHLCV._timestamp_scalar(end, timestamp_type))
+        if partitioned:
+            # Prune whole partition files by their date before any row group statistics are read
+            date = pc.field(DATE_PARTITION_COLUMN)
+            expr = expr & (date >= start.date()) & (date <= end.date())
+        return expr
+
+    @classmethod
+    @contextmanager
+    def shared_scan(cls):
+        """
+        Context manager sharing one OHLCV scan between the features computed inside it, see Feature.compute_many.
+
+        The scope starts in a planning pass: each OHLCV read is recorded and interrupts the feature computing it
+        by raising _ScanPlanned, use plan() to run a computation under it. load() then reads the union of the
+        recorded time ranges and columns once per OHLCV file and dtype, and afterwards every read inside that
+        union is sliced out of the scan. Reads it doesn't cover are read on their own as usual.
+
+        Yields:
+            _SharedScan: The state of the scope
+        """
+        previous = OHLCV._shared_scan
+        OHLCV._shared_scan = _SharedScan()
+        try:
+            yield OHLCV._shared_scan
+        finally:
+            OHLCV._shared_scan = previous
+
+    @staticmethod
+    def _load_shared_scan(shared: _SharedScan):
+        """
+        Read the union of the requests recorded by the planning pass of the shared scan, once per OHLCV file and dtype.
+        """
+        groups = {}
+        for ohlcv_path, dtype, start, end, columns, column_keys in shared.requests:
+            groups.setdefault((ohlcv_path, dtype), []).append((start, end, columns, column_keys))
+
+        for (ohlcv_path, dtype), requests in groups.items():
+            dataset = _open_dataset(ohlcv_path)
+            index_column, _, partitioned = _dataset_layout(ohlcv_path)
+            start = min(request[0] for request in requests)
+            end = max(request[1] for request in requests)
+            columns = list(dict.fromkeys(name for request in requests for name in request[2]))
+            column_keys = set(key for request in requests for key in request[3])
+
+            expr = OHLCV._range_filter(dataset, index_column, partitioned, start, end)
+            frame = OHLCV._read(dataset, index_column, partitioned, [index_column] + columns, expr, dtype)
+            shared.scans[(ohlcv_path, dtype)] = _Scan(start, end, column_keys, frame)
+
+    @staticmethod
+    def _read(dataset: ds.Dataset, index_column: str, partitioned: bool, columns: Union[List[str], None],
+              expr: Union[pc.Expression, None], dtype: Union[str, None]) -> pd.DataFrame:
+        """
+        Scan the dataset with the given column projection and filter (None reads everything)
+        and convert the result to a timestamp sorted pandas DataFrame.
+        """
+        if columns is None and partitioned:
+            # Leave out the partition column, it is not part of the stored data
+            columns = [name for name in dataset.schema.names if name != DATE_PARTITION_COLUMN]
+
+        # Threaded scan with readahead so decompression of the next row groups overlaps decoding of the current ones
+        scanner = dataset.scanner(
+            columns=columns,
+            filter=expr,
+            use_threads=True,
+            batch_size=SCAN_BATCH_SIZE,
+            batch_readahead=SCAN_BATCH_READAHEAD,
+            fragment_readahead=SCAN_FRAGMENT_READAHEAD,
+        )
+        table = scanner.to_table()
+        # Keep the pandas metadata so the index and the column MultiIndex are restored
+        if table.schema.metadata is None:
+            table = table.replace_schema_metadata(dataset.schema.metadata)
+        if dtype is not None:
+            table = _cast_float_columns(table, dtype)
+
+        # Release the arrow buffers column by column while converting so the data isn't held twice
+        df = table.to_pandas(self_destruct=True, split_blocks=True, use_threads=True)
+        del table
+
+        # A filtered scan preserves the file order, so only sort when the file is not declared
+        # sorted by timestamp and the index is actually out of order. Partitioned datasets span
+        # many files, so for those only the (cheap) monotonic check is used
+        declared_sorted = not partitioned and _is_sorted_by(dataset.files[0], index_column)
+        if not declared_sorted and not df.index.is_monotonic_increasing:
+            df = df.sort_index()
+
+        return df
+
+    def _load_ohlcv_data(self) -> Tuple[str, ds.Dataset]:
         """
+        Return the OHLCV parquet path and the file opened as a pyarrow dataset.
+        The config and the dataset handle are cached at module level, so only the first
+        call touches the filesystem; row groups are read lazily on each query.
+        """
+        ohlcv_path = None
         try:
             # Load config to get ohlcv_path
-            config_path = Path("~/.config/horcrux/horcrux_config.toml").expanduser()
-            config = toml.load(config_path)
+            config = _load_config()
             ohlcv_path = Path(config["ohlcv_path"]).expanduser()
-            
-            # Load the entire parquet file into memory
-            OHLCV.ohlcv_data = pd.read_parquet(ohlcv_path, engine='pyarrow')  
+
+            return str(ohlcv_path), _open_dataset(str(ohlcv_path))
         except FileNotFoundError:
             raise FileNotFoundError(f"OHLCV parquet file not found at {ohlcv_path}")
         except Exception as e:
             raise RuntimeError(f"Error loading OHLCV data: {str(e)}")
-    
+
+    @staticmethod
+    def _index_column(schema: pa.Schema) -> str:
+        """
+        Return the name of the parquet column holding the timestamp index.
+        """
+        pandas_metadata = schema.pandas_metadata or {}
+        for index_column in pandas_metadata.get("index_columns", []):
+            # RangeIndex entries are stored as dicts and have no physical column
+            if isinstance(index_column, str):
+                return index_column
+        return "timestamp"
+
+    @staticmethod
+    def _column_key(name: str) -> tuple:
+        """
+        Convert a flat parquet column name back to its (pair, field) key.
+
+        pandas stores MultiIndex columns as the string representation of the tuple,
+        e.g. "('BTC_USDT', 'close')". Single level columns are returned as (name,).
+        """
+        if name.startswith("("):
+            try:
+                return tuple(ast.literal_eval(name))
+            except (ValueError, SyntaxError):
+                pass
+        return (name,)
+
+    @staticmethod
+    def _timestamp_scalar(ts: pd.Timestamp, timestamp_type: pa.DataType) -> pa.Scalar:
+        """
+        Convert a UTC timestamp to an arrow scalar comparable with the timestamp column.
+        """
+        if timestamp_type.tz is None:
+            ts = ts.tz_convert(None)
+        return pa.scalar(ts, type=timestamp_type)
+
     @classmethod
     def clear_cache(cls):
         """
-        Clear the cached OHLCV data to free up memory.
+        Clear the cached config, OHLCV dataset handles, preloaded OHLCV data and everything computed from it to free up memory.
         Useful for testing or when you want to reload the data.
         """
-        cls.ohlcv_data = None
-        print("OHLCV data cache cleared.")
\ No newline at end of file
+        cls.preloaded_data.clear()
+        # Computed features and the TPSL binary trees are derived from the OHLCV data, so they are stale as well
+        Feature.clear_compute_cache()
+        from .tp_sl_pnl import TPSL_LogReturn
+        TPSL_LogReturn.clear_tree_cache()
+        _load_config.cache_clear()
+        _open_dataset.cache_clear()
+        _dataset_layout.cache_clear()
+        _is_sorted_by.cache_clear()
+        print("OHLCV data cache cleared.")
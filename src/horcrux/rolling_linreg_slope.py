@@ -5,47 +5,69 @@ import numba
 from typing import List
 from .ohlcv import OHLCV
 
-@numba.njit(cache=True)
 def fast_linreg_slope(y, window):
     """
-    Fast numba-compiled function to calculate rolling linear regression slope.
+    Rolling linear regression slope of a single series, computed by passing it to the fast_linreg_slope_2d kernel as one column.
     
     Args:
-        y: 1D numpy array of values
+        y: 1D numpy array of values, any layout or float dtype
         window: Rolling window size
         
     Returns:
         1D numpy array of slope values
     """
-    # Length of data
-    N = len(y)
+    values = np.ascontiguousarray(y, dtype=np.float64).reshape(-1, 1)
+    out = np.empty(values.shape, dtype=np.float64)
+    fast_linreg_slope_2d(values, int(window), out)
+    return out[:, 0]
+
+
+@numba.njit(parallel=True, fastmath=True, boundscheck=False, error_model='numpy', cache=True)
+def fast_linreg_slope_2d(Y, window, out):
+    """
+    Numba-compiled rolling linear regression slope over every column of a 2D array at once, with the
+    columns processed in parallel. The numerator of the slope is updated with an O(1) recurrence as the
+    window moves, so a column costs O(N) whatever the window size.
     
-    # Initialize the slope array
-    slope = np.full(N, np.nan)
+    Args:
+        Y: 2D numpy array of shape (N, K), ideally Fortran ordered so each column is contiguous
+        window: Rolling window size
+        out: Preallocated 2D numpy array of shape (N, K) the slopes are written to
+    """
+    N, K = Y.shape
     
-    # Initialize the window x values
+    # The denominator of the beta formula does not depend on the data, hoist it and its inverse out of all loops
     x_window = np.arange(window)
-    
-    # Calculate the denominator of the beta formula, it does not depend on x and so is just a constant we divide by
     denom = np.sum((x_window - x_window.mean()) ** 2)
+    inv_denom = 1.0 / denom
+    inv_window = 1.0 / window
+    # x_mean[i] = i - (window-1)/2 is the analytical rolling mean of x_i = i
+    half_window = (window - 1) / 2
     
-    # Calculate the array of x_i rolling mean values. Since x_i = i we have a an analytical expression for the mean
-    x_mean = np.arange(N) - (window-1)/2
-    
-    # We initialize all of the variables for the first value of beta that we calculate
-    # Mean of the first window values
-    y_i_mean = y[:window].mean()
-    c_i = ((x_window - x_mean[window-1])*(y[:window]- y_i_mean)).sum()
-    slope[window-1] = c_i/denom
-    
-    for i in range(window-1, N-1):
-        dy_i = y[i+1]-y[i-window+1]
-        # Iterate y_i+1_mean
-        y_i_mean = y_i_mean + dy_i/window
-        # Iterate c_i+1
-        c_i = c_i +dy_i+((i+1)-x_mean[i+1])*(y[i+1]-y_i_mean)-((i+1-window)-x_mean[i+1])*(y[i+1-window]-y_i_mean)
-        slope[i+1] = c_i/denom
-    return slope
+    for k in numba.prange(K):
+        for i in range(min(window - 1, N)):
+            out[i, k] = np.nan
+        if N < window:
+            continue
+        
+        # Mean of the first window values and the first c_i
+        y_i_mean = 0.0
+        for j in range(window):
+            y_i_mean += Y[j, k]
+        y_i_mean *= inv_window
+        c_i = 0.0
+        for j in range(window):
+            c_i += (j - half_window) * (Y[j, k] - y_i_mean)
+        out[window - 1, k] = c_i * inv_denom
+        
+        for i in range(window - 1, N - 1):
+            x_mean_next = (i + 1) - half_window
+            dy_i = Y[i + 1, k] - Y[i - window + 1, k]
+            # Iterate y_i+1_mean
+            y_i_mean = y_i_mean + dy_i * inv_window
+            # Iterate c_i+1
+            c_i = c_i + dy_i + ((i + 1) - x_mean_next) * (Y[i + 1, k] - y_i_mean) - ((i + 1 - window) - x_mean_next) * (Y[i + 1 - window, k] - y_i_mean)
+            out[i + 1, k] = c_i * inv_denom
 
 
 def rolling_linear_regression_slope_fast(data: pd.DataFrame, window: int = 14) -> pd.DataFrame:
@@ -59,16 +81,13 @@ def rolling_linear_regression_slope_fast(data: pd.DataFrame, window: int = 14) -
     Returns:
         DataFrame with rolling linear regression slopes
     """
-    slope_series_list = []
-    
-    for col in data.columns:
-        slope_values = fast_linreg_slope(data[col].values.astype(np.float64), window)
-        slope_series = pd.Series(slope_values, index=data.index, name=col)
-        slope_series_list.append(slope_series)
-    
-    slope_df = pd.concat(slope_series_list, axis=1)
+    # Column-major layout so every column the kernel walks is contiguous, this also matches
+    # pandas' internal block layout so the result is wrapped without a copy
+    values = np.asfortranarray(data.to_numpy(dtype=np.float64))
+    out = np.empty(values.shape, dtype=np.float64, order='F')
+    fast_linreg_slope_2d(values, window, out)
     
-    return slope_df
+    return pd.DataFrame(out, index=data.index, columns=data.columns)
 
 
 class RollingLinRegSlope(Feature):
@@ -99,32 +118,24 @@ class RollingLinRegSlope(Feature):
         """
         # Get extra history for rolling calculations
         extended_start = start - pd.Timedelta(minutes=window * 2)
-        base_data = base_feature.compute(extended_start, end, pairs)
+        base_data = base_feature.compute(extended_start, end)
         
-        # Create result DataFrame
-        slope_data = pd.DataFrame(index=base_data.index)
-        
-        # Process each column in base_data
-        for col in base_data.columns:
-            if isinstance(base_data.columns, pd.MultiIndex):
-                pair, feature_name = col
-                new_col_name = (pair, f"{feature_name}_slope")
-            else:
-                # Simple column case - treat column name as pair
-                pair = col
-                new_col_name = (pair, "slope")
-            
-            # Only process if pair is in requested pairs
-            if pair in pairs:
-                feature_series = base_data[col]
-                slope_values = fast_linreg_slope(feature_series.values.astype(np.float64), window)
-                slope_data[new_col_name] = slope_values
-        
-        # Ensure MultiIndex columns
-        if not isinstance(slope_data.columns, pd.MultiIndex):
-            slope_data.columns = pd.MultiIndex.from_tuples(
-                slope_data.columns, names=['pair', 'feature']
+        # Only process the columns of the requested pairs
+        if isinstance(base_data.columns, pd.MultiIndex):
+            selected = base_data.columns.get_level_values(0).isin(pairs)
+            selected_columns = base_data.columns[selected]
+            slope_columns = pd.MultiIndex.from_arrays(
+                [selected_columns.get_level_values(0), selected_columns.get_level_values(1) + "_slope"],
+                names=['pair', 'feature']
             )
+        else:
+            # Simple column case - treat column name as pair
+            selected = base_data.columns.isin(pairs)
+            slope_columns = pd.MultiIndex.from_product([base_data.columns[selected], ["slope"]], names=['pair', 'feature'])
+        
+        # Compute every selected column in one parallel kernel call, wrapped in a single DataFrame
+        slope_data = rolling_linear_regression_slope_fast(base_data.loc[:, selected], window)
+        slope_data.columns = slope_columns
         
         # Return only the requested time range
         return slope_data.loc[start:end] 
\ No newline at end of file
@@ -2,34 +2,47 @@ from .feature import Feature
 import pandas as pd
 import numpy as np
 import numba
-from typing import List
+import os
+from typing import Dict, List, Union
+from collections import OrderedDict
+from .log import FLog
 from .ohlcv import OHLCV
-import numba
 
-@numba.njit(cache=True)
-def calculate_single_exit_index_log(entry_index, close_log, high_log_bt, low_log_bt, tp_log, sl_log):
-    #Tolerance value needed because otherwise sometimes the sl/tp doesn't trigger because of numerical issues
-    epsilon = 1e-12
+# Every fastmath flag except nnan/ninf, leading NaN prices of a pair must keep comparing false
+TREE_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# fast_exit scans forward from every entry instead of building a binary tree when
+# entries * log2(N) < SPARSE_ENTRIES_FACTOR * N
+SPARSE_ENTRIES_FACTOR = 4
+
+@numba.njit(fastmath=TREE_FASTMATH, cache=True)
+def calculate_single_exit_index_log(entry_index, close_log, hl_bt, tp_log, sl_log):
+    #Tolerance value needed because otherwise sometimes the sl/tp doesn't trigger because of numerical issues.
+    #The tree holds float32 log prices, rounded by up to ~1e-6 at the magnitude of log prices, so it has to cover that
+    epsilon = 1e-6
     
-    tp = close_log[entry_index] + tp_log
-    sl = close_log[entry_index] + sl_log
+    #Trigger levels with the tolerance already applied
+    tp = close_log[entry_index] + tp_log - epsilon
+    sl = close_log[entry_index] + sl_log + epsilon
     #binary tree midpoint to get start of the single step data
-    bt_midpoint = len(high_log_bt) >> 1
+    bt_midpoint = len(hl_bt) >> 1
     #We take +1 as the starting point
     current_index = entry_index + bt_midpoint + 1
     #Exit not detected yet
     while True:
-        high = high_log_bt[current_index]   
-        low = low_log_bt[current_index]
+        #The high and low of a node are adjacent, one 16 byte load
+        high = hl_bt[current_index, 0]
+        low = hl_bt[current_index, 1]
         #We detected exit so we leave the loop
-        if high > tp - epsilon or low < sl + epsilon:
+        if high > tp or low < sl:
             break
         else:
             #This condition means that we have reached the right edge and are going to the right out of bounds therefore there is no trigger for the sl/tp in the whole data
             if current_index & (current_index + 1) == 0:
                 return bt_midpoint 
-            #If we are in the right cell we can't go up so we step to the right. If we are in the left cell we go up the binary tree
-            current_index = current_index + 1 if (current_index & 1) else current_index >> 1
+            #If we are in the right cell we can't go up so we step to the right. If we are in the left cell we go up the binary tree.
+            #Branchless: an odd index becomes current_index + 1, an even one (current_index + 1) >> 1 == current_index >> 1
+            current_index = (current_index + 1) >> (1 - (current_index & 1))
     #Exit detected
     while True:
         #If we are at the bottom of the tree we have reached the exit
@@ -38,79 +51,257 @@ def calculate_single_exit_index_log(entry_index, close_log, high_log_bt, low_log
         #We descend the tree and then check both of the leaves
         current_index = current_index << 1
         
-        high = high_log_bt[current_index]   
-        low = low_log_bt[current_index]
+        high = hl_bt[current_index, 0]
+        low = hl_bt[current_index, 1]
+        
+        #If the exit is triggered in the first leaf we go there, if not it is triggered in the second leaf. It must be triggered somewhere so if not the first then the second.
+        #Branchless, the trigger is unpredictable on market data
+        trigger = (high > tp) | (low < sl)
+        current_index += 1 - np.int64(trigger)
+        
+@numba.njit(parallel=True, cache=True)
+def build_bt_batch(high_log, low_log):
+    """
+    Build the binary trees of the log high and log low prices of every pair searched by calculate_single_exit_index_log.
+    The leaves [N, 2N) of a tree hold the log prices and every internal node i the max (high) / min (low) of its children 2i and 2i+1.
+    Each node stores its high and low side by side in one row of a (2N, 2) array, column 0 the high and 1 the low,
+    so the search reads both with a single cache line access. The tree is only compared against the tp/sl levels,
+    so it is kept in float32, halving the memory the search walks through. Pairs are built in parallel.
+    
+    Args:
+        high_log: 2D float32 numpy array of shape (N, P) of log high prices, N a power of 2, ideally Fortran ordered
+        low_log: 2D float32 numpy array of shape (N, P) of log low prices, N a power of 2, ideally Fortran ordered
+        
+    Returns:
+        (P, 2N, 2) float32 array of the high/low binary tree of every pair
+    """
+    N, P = high_log.shape
+    
+    #Init the binary tree arrays, every node but the unused root slot 0 is written below
+    hl_bt = np.empty((P, N * 2, 2), dtype=np.float32)
+    
+    for p in numba.prange(P):
+        hl_bt[p, 0, 0] = np.nan
+        hl_bt[p, 0, 1] = np.nan
         
-        #If the exit is triggered in the first leaf we go there, if not it is triggered in the second leaf. It must be triggered somewhere so if not the first then the second
-        current_index = current_index if (high > tp - epsilon or low < sl + epsilon) else current_index + 1
+        #The bottom level of the BT is just the values of the high and the low
+        for i in range(N):
+            hl_bt[p, N + i, 0] = high_log[i, p]
+            hl_bt[p, N + i, 1] = low_log[i, p]
+
+        current_length = N
         
-@numba.njit(cache=True)
-def calculate_exit_log_return(entries, close, high, low, tp_frac, sl_frac):
-    high_log = np.log(high)
-    low_log = np.log(low)
-    close_log = np.log(close)
-    
-    #Init the binary tree arrays
-    high_log_bt = np.full(len(high_log) * 2, np.nan)
-    low_log_bt = np.full(len(low_log) * 2, np.nan)
-    
-    #The bottom level of the BT is just the values of the high and the low
-    high_log_bt[len(high_log): 2*len(high_log)] = high_log
-    low_log_bt[len(low_log): 2*len(low_log)] = low_log
+        #Construct binary tree for high and low by resampling pairs
+        while current_length != 0:
+            current_length = current_length // 2
+            for i in range(current_length, 2*current_length):
+                hl_bt[p, i, 0] = max(hl_bt[p, 2*i, 0], hl_bt[p, 2*i + 1, 0])
+                hl_bt[p, i, 1] = min(hl_bt[p, 2*i, 1], hl_bt[p, 2*i + 1, 1])
+    
+    return hl_bt
 
-    current_length = len(high)
-    
-    #Construct binary tree for high and low by resampling pairs
-    while current_length != 0:
-        current_length = current_length // 2
-        for i in range(current_length, 2*current_length):
-            high_log_bt[i] = max(high_log_bt[2*i], high_log_bt[2*i + 1])
-            low_log_bt[i] = min(low_log_bt[2*i], low_log_bt[2*i + 1])
-             
-    result = np.full(len(entries), np.nan, dtype=np.float64)  # Use -1 for no exit, int32 for indices
-    for i in range(len(entries)):
-        if entries[i]:
-            exit_index = calculate_single_exit_index_log(i, close_log, high_log_bt, low_log_bt, np.log(1+tp_frac), np.log(1-sl_frac))
-            exit_index = min(exit_index, len(entries)-1)
-            log_return = close_log[exit_index] - close_log[i]
-            result[i] = log_return
-    return result
+@numba.njit(parallel=True, fastmath=TREE_FASTMATH, cache=True)
+def calculate_exit_log_return_batch(entries, close_log, hl_bt, tp_log, sl_log, out):
+    """
+    Log return of every entry of every pair until its tp or sl is hit, searching the binary trees of build_bt_batch.
+    
+    Args:
+        entries: 2D boolean numpy array of shape (T, P) marking the entries
+        close_log: 2D numpy array of shape (N, P) of log close prices padded like the trees, N >= T
+        hl_bt: (P, 2N, 2) array of binary trees from build_bt_batch
+        tp_log: Log of the take profit level relative to the entry price
+        sl_log: Log of the stop loss level relative to the entry price
+        out: Preallocated 2D numpy array of shape (T, P) the log returns are written to, NaN where there is no entry
+    """
+    T, P = entries.shape
+    for p in range(P):
+        close_p = close_log[:, p]
+        bt_p = hl_bt[p]
+        #Every entry is searched independently and writes only its own result, parallel over the entries
+        #rather than the pairs so it stays parallel with only a few pairs
+        for i in numba.prange(T):
+            if entries[i, p]:
+                exit_index = calculate_single_exit_index_log(i, close_p, bt_p, tp_log, sl_log)
+                exit_index = min(exit_index, T - 1)
+                out[i, p] = close_p[exit_index] - close_p[i]
+            else:
+                out[i, p] = np.nan
 
-def fast_exit(entries, ohlcv, tp_frac, sl_frac):
-    log_return = pd.DataFrame(-1, index=entries.index, columns=entries.columns, dtype=np.float64)
-    log2 = np.ceil(np.log2(len(entries)))
-    power_of_2 = int(2 ** log2)
-    
-    for pair in entries.columns.get_level_values(0).unique():
-        entries_for_pair = entries[pair].to_numpy(dtype=np.bool_)
-        close_for_pair   = ohlcv[pair]['close'].to_numpy()
-        high_for_pair    = ohlcv[pair]['high'].to_numpy()
-        low_for_pair     = ohlcv[pair]['low'].to_numpy()
+@numba.njit(parallel=True, fastmath=TREE_FASTMATH, cache=True)
+def linear_exit_log_return_batch(entries, close_log, high_log, low_log, tp_log, sl_log, out):
+    """
+    Same result as calculate_exit_log_return_batch, but every entry scans forward bar by bar until its tp or sl
+    is hit instead of searching a binary tree. Cheaper when there are too few entries to pay for building the trees.
+    
+    Args:
+        entries: 2D boolean numpy array of shape (T, P) marking the entries
+        close_log: 2D numpy array of shape (N, P) of log close prices, N >= T, rows past T are ignored
+        high_log: 2D float32 numpy array of shape (N, P) of log high prices, N >= T, rows past T are ignored
+        low_log: 2D float32 numpy array of shape (N, P) of log low prices, N >= T, rows past T are ignored
+        tp_log: Log of the take profit level relative to the entry price
+        sl_log: Log of the stop loss level relative to the entry price
+        out: Preallocated 2D numpy array of shape (T, P) the log returns are written to, NaN where there is no entry
+    """
+    #Same tolerance as calculate_single_exit_index_log
+    epsilon = 1e-6
+    T, P = entries.shape
+    for p in range(P):
+        for i in numba.prange(T):
+            if entries[i, p]:
+                tp = close_log[i, p] + tp_log - epsilon
+                sl = close_log[i, p] + sl_log + epsilon
+                #Hold to the end of the data if nothing triggers
+                exit_index = T - 1
+                for j in range(i + 1, T):
+                    if high_log[j, p] > tp or low_log[j, p] < sl:
+                        exit_index = j
+                        break
+                out[i, p] = close_log[exit_index, p] - close_log[i, p]
+            else:
+                out[i, p] = np.nan
 
-        #We pad the data to a power of 2 so that we can construct a binary tree
-        close_for_pair = np.pad(close_for_pair, (0, power_of_2 - len(close_for_pair)), mode='edge')
-        high_for_pair = np.pad(high_for_pair, (0, power_of_2 - len(high_for_pair)), mode='edge')
-        low_for_pair = np.pad(low_for_pair, (0, power_of_2 - len(low_for_pair)), mode='edge')
-        log_return[pair] = calculate_exit_log_return(entries_for_pair, close_for_pair, high_for_pair, low_for_pair, tp_frac, sl_frac)[:len(entries_for_pair)]
+def fast_exit(entries, ohlcv, tp_frac, sl_frac, trees = None, log_prices = False):
+    """
+    Log return of every entry until its take profit or stop loss is hit, or of holding to the end of the data.
+    
+    Args:
+        entries: Boolean DataFrame with one column per pair marking the entries, or None to enter at every row of every pair in ohlcv
+        ohlcv: OHLCV DataFrame with (pair, field) columns, aligned with entries
+        tp_frac: Take profit as a fraction of the entry price
+        sl_frac: Stop loss as a fraction of the entry price
+        trees: Optional dict the trees of the pairs of entries over this ohlcv are cached in, keyed by the tuple of pairs.
+               Lets calls over a grid of tp/sl values on the same data build the trees once
+        log_prices: Whether ohlcv already holds log prices, e.g. the output of FLog over OHLCV
         
-    return log_return
+    Returns:
+        DataFrame of log returns with the columns of entries (the pairs of ohlcv when entries is None), NaN where there is no entry
+    """
+    # Every pair is handled by a single kernel call filling one array, wrapped in a DataFrame once at the end
+    if entries is None:
+        # Every row is an entry, no need for the caller to build a DataFrame of True
+        pair_names = ohlcv.columns.get_level_values(0).unique()
+        index = ohlcv.index
+        entries_np = np.ones((len(index), len(pair_names)), dtype=np.bool_, order='F')
+    else:
+        pair_names = entries.columns.get_level_values(0).unique()
+        index = entries.index
+        entries_np = np.asfortranarray(entries[pair_names].to_numpy(dtype=np.bool_))
+    T = len(index)
+    log_return = np.empty((T, len(pair_names)), dtype=np.float64, order='F')
+    #The tree needs a leaf after the last entry, the search starts one step to its right
+    log2 = T.bit_length()
+    power_of_2 = 1 << log2
+    
+    # The tp/sl levels are the same for every entry, take their logs once. log1p keeps the precision of small fractions
+    tp_log = np.log1p(tp_frac)
+    sl_log = np.log1p(-sl_frac)
+    
+    key = tuple(pair_names)
+    tree = trees.get(key) if trees is not None else None
+    if tree is None:
+        # Prices of every pair taken from ohlcv once as padded [power_of_2, P] Fortran ordered arrays,
+        # so each pair is a contiguous column instead of three MultiIndex lookups per pair.
+        # High and low are only compared against the tp/sl levels and are stored in float32 like the trees, so
+        # the linear scan and the tree search see the same values. Close stays float64 for the log returns
+        prices = {}
+        for field in ('close', 'high', 'low'):
+            values = ohlcv.xs(field, axis=1, level=1)[pair_names].to_numpy(dtype=np.float64)
+            if not log_prices:
+                values = np.log(values)
+            #We pad the data to a power of 2 with the last row so that we can construct a binary tree
+            padded = np.empty((power_of_2, len(pair_names)), dtype=np.float64 if field == 'close' else np.float32, order='F')
+            padded[:T] = values
+            padded[T:] = values[-1]
+            prices[field] = padded
+        
+        #Building the trees is O(N), with few entries scanning forward from each of them directly is cheaper
+        if np.count_nonzero(entries_np) * log2 < SPARSE_ENTRIES_FACTOR * power_of_2 * len(pair_names):
+            linear_exit_log_return_batch(entries_np, prices['close'], prices['high'], prices['low'], tp_log, sl_log, log_return)
+            return pd.DataFrame(log_return, index=index, columns=pair_names, copy=False)
+        
+        tree = (prices['close'], build_bt_batch(prices['high'], prices['low']))
+        if trees is not None:
+            trees[key] = tree
+    
+    close_log, hl_bt = tree
+    calculate_exit_log_return_batch(entries_np, close_log, hl_bt, tp_log, sl_log, log_return)
+    
+    return pd.DataFrame(log_return, index=index, columns=pair_names, copy=False)
 
 
 class TPSL_LogReturn(Feature):
+    # Binary trees built by fast_exit keyed by (start_ns, end_ns), each a dict of pairs -> trees, so the
+    # features of a tp/sl grid over the same range build them once. It holds the trees of at most tree_cache_size
+    # ranges taking tree_cache_max_bytes in total, set either to 0 to disable it. OHLCV.clear_cache clears it
+    _tree_cache = OrderedDict()
+    tree_cache_size = 4
+    tree_cache_max_bytes = 512 << 20
     
     def _compute_impl(self, start: pd.Timestamp, end: pd.Timestamp, pairs: List[str], tp_frac = 0.05, sl_frac = 0.05) -> pd.DataFrame:
-        # Get extra history for rolling calculations
-        ohlcv = OHLCV().compute(start, end, pairs)
-        entries = pd.DataFrame(True, index=ohlcv.index, columns=ohlcv.columns.get_level_values(0).unique())
-        tp_sl_log_return = fast_exit(entries, ohlcv, tp_frac, sl_frac)
-        
-        # Create MultiIndex DataFrame with (pair, feature) structure
-        result = pd.DataFrame(index=tp_sl_log_return.index)
-        for pair in pairs:
-            if pair in tp_sl_log_return.columns:
-                result[(pair, 'tpsl_logreturns')] = tp_sl_log_return[pair]
+        # Log prices through FLog, so they are taken once and shared through the compute cache by every TPSL feature on the pairs
+        log_ohlcv = FLog(pairs, base_feature = OHLCV(pairs, fields = ["high", "low", "close"])).compute(start, end)
+        # Every row is an entry
+        tp_sl_log_return = fast_exit(None, log_ohlcv, tp_frac, sl_frac, trees = self._trees(start, end), log_prices = True)
+        self._trim_tree_cache()
         
-        # Set proper MultiIndex column names
-        result.columns = pd.MultiIndex.from_tuples(result.columns, names=['pair', 'feature'])
+        # Create MultiIndex DataFrame with (pair, feature) structure in one construction
+        result_pairs = [pair for pair in pairs if pair in tp_sl_log_return.columns]
+        columns = pd.MultiIndex.from_product([result_pairs, ['tpsl_logreturns']], names=['pair', 'feature'])
         
-        return result 
\ No newline at end of file
+        return pd.DataFrame(tp_sl_log_return[result_pairs].to_numpy(), index=tp_sl_log_return.index, columns=columns, copy=False)
+    
+    @classmethod
+    def _trees(cls, start: pd.Timestamp, end: pd.Timestamp) -> Union[Dict, None]:
+        """
+        Return the cached dict of binary trees for the range, creating it if needed. None when caching is disabled.
+        """
+        if cls.tree_cache_size <= 0 or cls.tree_cache_max_bytes <= 0:
+            return None
+        key = (start.value, end.value)
+        cache = TPSL_LogReturn._tree_cache
+        if key in cache:
+            cache.move_to_end(key)
+        else:
+            cache[key] = {}
+            while len(cache) > cls.tree_cache_size:
+                cache.popitem(last=False)
+        return cache[key]
+    
+    @classmethod
+    def _trim_tree_cache(cls):
+        """
+        Evict the least recently used ranges until the cached trees take at most tree_cache_max_bytes.
+        """
+        cache = TPSL_LogReturn._tree_cache
+        sizes = [sum(close_log.nbytes + hl_bt.nbytes for close_log, hl_bt in trees.values()) for trees in cache.values()]
+        total = sum(sizes)
+        for size in sizes:
+            if total <= cls.tree_cache_max_bytes:
+                break
+            cache.popitem(last=False)
+            total -= size
+    
+    @classmethod
+    def clear_tree_cache(cls):
+        """
+        Clear the cached binary trees, e.g. after the underlying OHLCV data changed.
+        """
+        TPSL_LogReturn._tree_cache.clear()
+
+
+def _warmup():
+    """
+    Compile the TPSL kernels on tiny inputs with the same argument types fast_exit passes them, so the
+    first real call doesn't stall on JIT. With cache=True this mostly loads the compiled code from disk.
+    """
+    entries = np.ones((4, 2), dtype=np.bool_, order='F')
+    close_log = np.zeros((8, 2), dtype=np.float64, order='F')
+    hl_log = np.zeros((8, 2), dtype=np.float32, order='F')
+    tp_log, sl_log = np.log1p(0.01), np.log1p(-0.01)
+    out = np.empty((4, 2), dtype=np.float64, order='F')
+    hl_bt = build_bt_batch(hl_log, hl_log)
+    calculate_exit_log_return_batch(entries, close_log, hl_bt, tp_log, sl_log, out)
+    linear_exit_log_return_batch(entries, close_log, hl_log, hl_log, tp_log, sl_log, out)
+
+if os.environ.get('HORCRUX_WARMUP'):
+    _warmup()
@@ -1,7 +1,277 @@
 from .feature import Feature
+from .ohlcv import OHLCV
 import pandas as pd
+import numpy as np
+import numba
+import os
 from typing import List
 
+@numba.njit(parallel=True, cache=True)
+def rolling_mean_std_2d(X, window, min_periods, mean_out, std_out):
+    """
+    Numba-compiled rolling mean and sample standard deviation of every column of a 2D array in a single pass,
+    matching pandas' rolling(window, min_periods).mean() and .std(). Columns are processed in parallel.
+    
+    The window statistics are updated with Welford's online algorithm as values enter and leave the window,
+    NaNs are skipped and don't count towards min_periods. Like pandas, a window whose values are all equal
+    gets a standard deviation of exactly 0 instead of the rounding residue of the updates.
+    
+    Args:
+        X: 2D numpy array of shape (N, K), ideally Fortran ordered so each column is contiguous
+        window: Rolling window size
+        min_periods: Minimum number of non-NaN observations in the window required to have a value
+        mean_out: Preallocated 2D numpy array of shape (N, K) the rolling means are written to
+        std_out: Preallocated 2D numpy array of shape (N, K) the rolling standard deviations are written to
+    """
+    N, K = X.shape
+    min_obs = max(min_periods, 1)
+    
+    for k in numba.prange(K):
+        nobs = 0
+        mean = 0.0
+        # Sum of squared differences from the current mean
+        ssqdm = 0.0
+        # Last value added and how many times in a row it was added
+        prev = np.nan
+        same_count = 0
+        
+        for i in range(N):
+            # Remove the value leaving the window
+            if i >= window:
+                x_old = X[i - window, k]
+                if not np.isnan(x_old):
+                    nobs -= 1
+                    if nobs > 0:
+                        delta = x_old - mean
+                        mean -= delta / nobs
+                        ssqdm -= delta * (x_old - mean)
+                    else:
+                        mean = 0.0
+                        ssqdm = 0.0
+            
+            # Add the value entering the window
+            x = X[i, k]
+            if not np.isnan(x):
+                nobs += 1
+                delta = x - mean
+                mean += delta / nobs
+                ssqdm += delta * (x - mean)
+                if x == prev:
+                    same_count += 1
+                else:
+                    same_count = 1
+                prev = x
+            
+            if nobs < min_obs:
+                mean_out[i, k] = np.nan
+                std_out[i, k] = np.nan
+            elif same_count >= nobs:
+                mean_out[i, k] = prev
+                std_out[i, k] = 0.0 if nobs > 1 else np.nan
+            else:
+                mean_out[i, k] = mean
+                if nobs > 1:
+                    std_out[i, k] = np.sqrt(max(ssqdm / (nobs - 1), 0.0))
+                else:
+                    std_out[i, k] = np.nan
+
+
+def rolling_zscore(values: np.ndarray, window: int, min_periods: int) -> np.ndarray:
+    """
+    Rolling Z-score of every column of a 2D array, 0 wherever it is undefined (NaN statistics or zero std).
+    
+    Args:
+        values: 2D float64 numpy array of shape (N, K)
+        window: Rolling window size
+        min_periods: Minimum number of observations required to have a value
+        
+    Returns:
+        2D numpy array of shape (N, K) with the Z-scores
+    """
+    values = np.asfortranarray(values, dtype=np.float64)
+    rolling_mean = np.empty(values.shape, dtype=np.float64, order='F')
+    rolling_std = np.empty(values.shape, dtype=np.float64, order='F')
+    rolling_mean_std_2d(values, window, min_periods, rolling_mean, rolling_std)
+    
+    # Divide only where the Z-score is defined, everything else (zero or NaN std, NaN values) stays 0.
+    # One masked pass instead of dividing everything and cleaning up the NaN and infinite values afterwards
+    numerator = values - rolling_mean
+    zscore = np.zeros_like(numerator)
+    np.divide(numerator, rolling_std, out=zscore, where=(rolling_std > 0) & np.isfinite(numerator))
+    
+    return zscore
+
+
+@numba.njit(cache=True)
+def _fenwick_kth(counts, top_step, k):
+    """
+    Return the 0-based rank of the k-th smallest value counted in a Fenwick tree of counts over 1-based ranks.
+    top_step is the largest power of 2 not above the number of ranks.
+    """
+    n = len(counts) - 1
+    pos = 0
+    step = top_step
+    while step > 0:
+        if pos + step <= n and counts[pos + step] < k:
+            pos += step
+            k -= counts[pos]
+        step >>= 1
+    return pos
+
+@numba.njit(parallel=True, cache=True)
+def rolling_quantile_2d(X, window, min_periods, quantile, out):
+    """
+    Numba-compiled exact rolling quantile of every column of a 2D array, matching pandas'
+    rolling(window, min_periods).quantile(quantile) with linear interpolation. Columns are processed in parallel.
+    
+    Each column is sorted once to rank its values, and the window is kept as a Fenwick tree of counts over
+    the ranks, so adding, removing and finding the k-th smallest value of the window are all O(log N)
+    instead of shifting a sorted window of up to window values on every row. NaNs are skipped and don't
+    count towards min_periods.
+    
+    Args:
+        X: 2D numpy array of shape (N, K), ideally Fortran ordered so each column is contiguous
+        window: Rolling window size
+        min_periods: Minimum number of non-NaN observations in the window required to have a value
+        quantile: Quantile to compute, between 0 and 1
+        out: Preallocated 2D numpy array of shape (N, K) the rolling quantiles are written to
+    """
+    N, K = X.shape
+    min_obs = max(min_periods, 1)
+    # Largest power of 2 not above N, the first step of the Fenwick tree descent
+    top_step = 1
+    while top_step * 2 <= N:
+        top_step *= 2
+    
+    for k in numba.prange(K):
+        # Values in sorted order (NaNs last) and the 1-based rank of every row
+        order = np.argsort(X[:, k], kind='mergesort')
+        sorted_values = np.empty(N, dtype=np.float64)
+        rank = np.empty(N, dtype=np.int64)
+        for r in range(N):
+            sorted_values[r] = X[order[r], k]
+            rank[order[r]] = r + 1
+        counts = np.zeros(N + 1, dtype=np.int64)
+        nobs = 0
+        
+        for i in range(N):
+            # Add the value entering the window
+            if not np.isnan(X[i, k]):
+                nobs += 1
+                j = rank[i]
+                while j <= N:
+                    counts[j] += 1
+                    j += j & -j
+            
+            # Remove the value leaving the window
+            if i >= window and not np.isnan(X[i - window, k]):
+                nobs -= 1
+                j = rank[i - window]
+                while j <= N:
+                    counts[j] -= 1
+                    j += j & -j
+            
+            if nobs < min_obs:
+                out[i, k] = np.nan
+                continue
+            
+            # Same position and interpolation as pandas
+            idx_with_fraction = quantile * (nobs - 1)
+            idx = np.int64(idx_with_fraction)
+            interpolate = nobs > 1 and idx != idx_with_fraction
+            
+            # The (idx + 1)-th smallest value in the window, and the next one when interpolating
+            vlow = sorted_values[_fenwick_kth(counts, top_step, idx + 1)]
+            if interpolate:
+                vhigh = sorted_values[_fenwick_kth(counts, top_step, idx + 2)]
+                out[i, k] = vlow + (vhigh - vlow) * (idx_with_fraction - idx)
+            else:
+                out[i, k] = vlow
+
+
+@numba.njit(parallel=True, cache=True)
+def adaptive_zscore_2d(X, windows, min_window, out):
+    """
+    Numba-compiled Z-score of every column of a 2D array over a window whose size changes at every row,
+    matching the mean and sample standard deviation of each X[i-w+1:i+1] slice. Columns are processed in parallel.
+    
+    Rather than recomputing each slice, the window statistics are updated with Welford's online algorithm
+    as the window bounds move, so a column costs O(N + total movement of the window start). NaNs are skipped,
+    slices of a single row are NaN, and a zero or undefined standard deviation gives a Z-score of 0.
+    
+    Args:
+        X: 2D numpy array of shape (N, K), ideally Fortran ordered so each column is contiguous
+        windows: 2D integer numpy array of shape (N, K) with the window size of every row, negative for
+                 rows without a window size, which are left NaN
+        min_window: Lower bound applied to the window sizes
+        out: Preallocated 2D numpy array of shape (N, K) the Z-scores are written to
+    """
+    N, K = X.shape
+    
+    for k in numba.prange(K):
+        nobs = 0
+        mean = 0.0
+        # Sum of squared differences from the current mean
+        ssqdm = 0.0
+        # The window covers X[lo:i+1]
+        lo = 0
+        # Last value added at the end of the window and how many times in a row it was added
+        prev = np.nan
+        same_count = 0
+        
+        for i in range(N):
+            # Every row enters the window at its end
+            x = X[i, k]
+            if not np.isnan(x):
+                nobs += 1
+                delta = x - mean
+                mean += delta / nobs
+                ssqdm += delta * (x - mean)
+                if x == prev:
+                    same_count += 1
+                else:
+                    same_count = 1
+                prev = x
+            
+            w = windows[i, k]
+            if w < 0:
+                out[i, k] = np.nan
+                continue
+            new_lo = max(0, i - max(w, min_window) + 1)
+            
+            # Shrink the window from the start
+            while lo < new_lo:
+                x_old = X[lo, k]
+                if not np.isnan(x_old):
+                    nobs -= 1
+                    if nobs > 0:
+                        delta = x_old - mean
+                        mean -= delta / nobs
+                        ssqdm -= delta * (x_old - mean)
+                    else:
+                        mean = 0.0
+                        ssqdm = 0.0
+                lo += 1
+            # Grow the window backwards
+            while lo > new_lo:
+                lo -= 1
+                x_old = X[lo, k]
+                if not np.isnan(x_old):
+                    nobs += 1
+                    delta = x_old - mean
+                    mean += delta / nobs
+                    ssqdm += delta * (x_old - mean)
+            
+            if i - lo < 1:
+                out[i, k] = np.nan
+            elif nobs < 2 or same_count >= nobs:
+                # Undefined or (all values equal) exactly zero standard deviation
+                out[i, k] = 0.0
+            else:
+                std = np.sqrt(max(ssqdm / (nobs - 1), 0.0))
+                out[i, k] = (x - mean) / std if std > 0 else 0.0
+
+
 class ZScore(Feature):
     """
     Transforms any given feature into its Z-score (standardized score).
@@ -44,76 +314,116 @@ class ZScore(Feature):
         # Get the base feature data with extra history for rolling calculations
         # We need additional data points to calculate meaningful rolling statistics
         extended_start = start - pd.Timedelta(minutes=window)
-        base_data = base_feature.compute(extended_start, end, pairs)
+        base_data = base_feature.compute(extended_start, end)
         
         # Handle both single and multi-feature cases
         if isinstance(base_data.columns, pd.MultiIndex):
             # Multi-feature case (e.g., MACD with macd_line and macd_histogram)
-            zscore_data = pd.DataFrame(index=base_data.index)
-            
-            # Process each pair and feature combination
-            for pair in pairs:
-                if pair in base_data.columns.get_level_values(0):
-                    pair_data = base_data[pair]
-                    
-                    for feature_name in pair_data.columns:
-                        feature_series = pair_data[feature_name]
-                        
-                        # Calculate rolling mean and standard deviation
-                        rolling_mean = feature_series.rolling(
-                            window=window, 
-                            min_periods=min_periods
-                        ).mean()
-                        
-                        rolling_std = feature_series.rolling(
-                            window=window, 
-                            min_periods=min_periods
-                        ).std()
-                        
-                        # Compute Z-score: (value - mean) / std
-                        # Handle division by zero by setting zscore to 0 when std is 0
-                        zscore = (feature_series - rolling_mean) / rolling_std
-                        zscore = zscore.fillna(0)  # Handle NaN values
-                        zscore = zscore.replace([float('inf'), float('-inf')], 0)  # Handle infinite values
-                        
-                        # Store with MultiIndex column structure
-                        zscore_data[(pair, f"{feature_name}_zscore")] = zscore
-            
-            # Create proper MultiIndex for columns
-            zscore_data.columns = pd.MultiIndex.from_tuples(
-                zscore_data.columns, 
+            # Select every feature column of each requested pair, in the order of pairs
+            pair_level = base_data.columns.get_level_values(0)
+            positions = np.concatenate([np.flatnonzero(pair_level == pair) for pair in pairs] + [np.empty(0, dtype=np.intp)])
+            selected_columns = base_data.columns[positions]
+            
+            zscore = rolling_zscore(base_data.iloc[:, positions].to_numpy(dtype=np.float64), window, min_periods)
+            
+            # Store with MultiIndex column structure
+            zscore_columns = pd.MultiIndex.from_arrays(
+                [selected_columns.get_level_values(0), selected_columns.get_level_values(1) + "_zscore"],
                 names=['pair', 'feature']
             )
+            zscore_data = pd.DataFrame(zscore, index=base_data.index, columns=zscore_columns, copy=False)
             
         else:
             # Single feature case (e.g., RSI, simple moving average)
-            zscore_data = pd.DataFrame(index=base_data.index, columns=base_data.columns)
-            
-            for pair in pairs:
-                if pair in base_data.columns:
-                    feature_series = base_data[pair]
-                    
-                    # Calculate rolling statistics
-                    rolling_mean = feature_series.rolling(
-                        window=window, 
-                        min_periods=min_periods
-                    ).mean()
-                    
-                    rolling_std = feature_series.rolling(
-                        window=window, 
-                        min_periods=min_periods
-                    ).std()
-                    
-                    # Compute Z-score with robust error handling
-                    zscore = (feature_series - rolling_mean) / rolling_std
-                    zscore = zscore.fillna(0)  # Replace NaN with 0
-                    zscore = zscore.replace([float('inf'), float('-inf')], 0)  # Replace inf with 0
-                    
-                    zscore_data[pair] = zscore
+            # Columns of pairs that weren't requested are kept and left NaN
+            positions = np.flatnonzero(base_data.columns.isin(pairs))
+            values = np.full(base_data.shape, np.nan, order='F')
+            values[:, positions] = rolling_zscore(base_data.iloc[:, positions].to_numpy(dtype=np.float64), window, min_periods)
+            zscore_data = pd.DataFrame(values, index=base_data.index, columns=base_data.columns, copy=False)
         
         # Return only the requested time range to match the interface specification
         return zscore_data.loc[start:end]
     
+@numba.experimental.jitclass([
+    ('window', numba.int64),
+    ('min_periods', numba.int64),
+    ('buf', numba.float64[::1]),
+    ('head', numba.int64),
+    ('count', numba.int64),
+    ('nobs', numba.int64),
+    ('mean', numba.float64),
+    ('ssqdm', numba.float64),
+    ('prev', numba.float64),
+    ('same_count', numba.int64),
+])
+class ZScoreStream:
+    """
+    Streaming counterpart of ZScore for a single series, updated one value at a time in O(1).
+    
+    Keeps the last window values in a ring buffer and the window mean and sum of squared differences with
+    Welford's algorithm, the same updates as rolling_mean_std_2d. Feeding a series value by value gives the
+    same Z-scores as rolling_zscore on the whole series, including 0 wherever the Z-score is undefined.
+    
+    Args:
+        window: Rolling window size
+        min_periods: Minimum number of non-NaN observations in the window required to have a value
+    """
+    
+    def __init__(self, window, min_periods):
+        self.window = window
+        self.min_periods = max(min_periods, 1)
+        self.buf = np.full(window, np.nan)
+        self.head = 0
+        self.count = 0
+        self.nobs = 0
+        self.mean = 0.0
+        self.ssqdm = 0.0
+        # Last value added and how many times in a row it was added
+        self.prev = np.nan
+        self.same_count = 0
+    
+    def update(self, x):
+        """
+        Add the next value of the series and return its Z-score.
+        """
+        # Remove the value leaving the window, it is the one about to be overwritten
+        if self.count == self.window:
+            x_old = self.buf[self.head]
+            if not np.isnan(x_old):
+                self.nobs -= 1
+                if self.nobs > 0:
+                    delta = x_old - self.mean
+                    self.mean -= delta / self.nobs
+                    self.ssqdm -= delta * (x_old - self.mean)
+                else:
+                    self.mean = 0.0
+                    self.ssqdm = 0.0
+        else:
+            self.count += 1
+        self.buf[self.head] = x
+        self.head = (self.head + 1) % self.window
+        
+        # Add the new value
+        if not np.isnan(x):
+            self.nobs += 1
+            delta = x - self.mean
+            self.mean += delta / self.nobs
+            self.ssqdm += delta * (x - self.mean)
+            if x == self.prev:
+                self.same_count += 1
+            else:
+                self.same_count = 1
+            self.prev = x
+        
+        # Not enough observations, a single one, or a window of identical values: the Z-score is undefined
+        if self.nobs < self.min_periods or self.nobs < 2 or self.same_count >= self.nobs:
+            return 0.0
+        std = np.sqrt(max(self.ssqdm / (self.nobs - 1), 0.0))
+        numerator = x - self.mean
+        if std > 0 and np.isfinite(numerator):
+            return numerator / std
+        return 0.0
+
 class AdaptiveZScore(Feature):
     """
     An adaptive Z-score that adjusts the window size based on market volatility.
@@ -143,83 +453,79 @@ class AdaptiveZScore(Feature):
         extended_start = start - pd.Timedelta(minutes=max_window)
         
         # Get base feature data
-        base_data = base_feature.compute(extended_start, end, pairs)
+        base_data = base_feature.compute(extended_start, end)
         
         # Get OHLCV data to measure volatility
-        from .ohlcv import OHLCV
-        ohlcv = OHLCV().compute(extended_start, end, pairs)
+        ohlcv = OHLCV(pairs, fields=["close"]).compute(extended_start, end)
         close_prices = ohlcv.xs("close", axis=1, level=1)
         
         # Calculate rolling volatility (standard deviation of returns)
         returns = close_prices.pct_change()
         volatility = returns.rolling(window=volatility_lookback).std()
         
-        # Normalize volatility to [0, 1] range for each pair
-        vol_normalized = volatility.div(volatility.rolling(window=base_window).quantile(0.95), axis=1)
-        vol_normalized = vol_normalized.clip(0, 1).fillna(0.5)
+        # Normalize volatility to [0, 1] range for each pair, by its exact rolling 95th percentile computed
+        # for all pairs in one parallel kernel. The rest runs on the whole [T, P] array
+        volatility_values = np.asfortranarray(volatility.to_numpy(dtype=np.float64))
+        vol_quantile = np.empty(volatility_values.shape, dtype=np.float64, order='F')
+        rolling_quantile_2d(volatility_values, base_window, base_window, 0.95, vol_quantile)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vol_normalized = np.clip(volatility_values / vol_quantile, 0, 1)
+        vol_normalized[np.isnan(vol_normalized)] = 0.5
         
         # Calculate adaptive window sizes
         # High volatility -> shorter window, Low volatility -> longer window
-        adaptive_windows = base_window * (1 - adaptation_factor * vol_normalized)
-        adaptive_windows = adaptive_windows.round().astype(int)
+        adaptive_windows = np.rint(base_window * (1 - adaptation_factor * vol_normalized)).astype(np.int64)
+        
+        # Align the window sizes with the base feature rows, rows without one are marked -1 and left NaN
+        adaptive_windows = pd.DataFrame(adaptive_windows, index=close_prices.index, columns=close_prices.columns, copy=False)
+        adaptive_windows = adaptive_windows.reindex(base_data.index, fill_value=-1)
         
         # Compute adaptive Z-scores
         if isinstance(base_data.columns, pd.MultiIndex):
-            zscore_data = pd.DataFrame(index=base_data.index)
-            
-            for pair in pairs:
-                if pair in base_data.columns.get_level_values(0):
-                    pair_data = base_data[pair]
-                    pair_windows = adaptive_windows[pair]
-                    
-                    for feature_name in pair_data.columns:
-                        feature_series = pair_data[feature_name]
-                        zscore_series = pd.Series(index=feature_series.index, dtype=float)
-                        
-                        # Calculate adaptive Z-score for each timestamp
-                        for timestamp in feature_series.index:
-                            if timestamp in pair_windows.index:
-                                window_size = max(pair_windows[timestamp], volatility_lookback)
-                                end_idx = feature_series.index.get_loc(timestamp)
-                                start_idx = max(0, end_idx - window_size + 1)
-                                
-                                window_data = feature_series.iloc[start_idx:end_idx+1]
-                                if len(window_data) > 1:
-                                    mean_val = window_data.mean()
-                                    std_val = window_data.std()
-                                    if std_val > 0:
-                                        zscore_series[timestamp] = (feature_series[timestamp] - mean_val) / std_val
-                                    else:
-                                        zscore_series[timestamp] = 0
-                        
-                        zscore_data[(pair, f"{feature_name}_adaptive_zscore")] = zscore_series
-            
-            zscore_data.columns = pd.MultiIndex.from_tuples(zscore_data.columns, names=['pair', 'feature'])
+            # Select every feature column of each requested pair, in the order of pairs
+            pair_level = base_data.columns.get_level_values(0)
+            positions = np.concatenate([np.flatnonzero(pair_level == pair) for pair in pairs] + [np.empty(0, dtype=np.intp)])
+            selected_columns = base_data.columns[positions]
+            
+            zscore = self._adaptive_zscore(base_data.iloc[:, positions], adaptive_windows, selected_columns.get_level_values(0), volatility_lookback)
+            
+            zscore_columns = pd.MultiIndex.from_arrays(
+                [selected_columns.get_level_values(0), selected_columns.get_level_values(1) + "_adaptive_zscore"],
+                names=['pair', 'feature']
+            )
+            zscore_data = pd.DataFrame(zscore, index=base_data.index, columns=zscore_columns, copy=False)
             
         else:
-            zscore_data = pd.DataFrame(index=base_data.index, columns=base_data.columns)
-            
-            for pair in pairs:
-                if pair in base_data.columns and pair in adaptive_windows.columns:
-                    feature_series = base_data[pair]
-                    pair_windows = adaptive_windows[pair]
-                    zscore_series = pd.Series(index=feature_series.index, dtype=float)
-                    
-                    for timestamp in feature_series.index:
-                        if timestamp in pair_windows.index:
-                            window_size = max(pair_windows[timestamp], volatility_lookback)
-                            end_idx = feature_series.index.get_loc(timestamp)
-                            start_idx = max(0, end_idx - window_size + 1)
-                            
-                            window_data = feature_series.iloc[start_idx:end_idx+1]
-                            if len(window_data) > 1:
-                                mean_val = window_data.mean()
-                                std_val = window_data.std()
-                                if std_val > 0:
-                                    zscore_series[timestamp] = (feature_series[timestamp] - mean_val) / std_val
-                                else:
-                                    zscore_series[timestamp] = 0
-                    
-                    zscore_data[pair] = zscore_series
-        
-        return zscore_data.loc[start:end]
\ No newline at end of file
+            # Columns of pairs that weren't requested are kept and left NaN
+            positions = np.flatnonzero(base_data.columns.isin(pairs) & base_data.columns.isin(adaptive_windows.columns))
+            values = np.full(base_data.shape, np.nan, order='F')
+            values[:, positions] = self._adaptive_zscore(base_data.iloc[:, positions], adaptive_windows, base_data.columns[positions], volatility_lookback)
+            zscore_data = pd.DataFrame(values, index=base_data.index, columns=base_data.columns, copy=False)
+        
+        return zscore_data.loc[start:end]
+    
+    @staticmethod
+    def _adaptive_zscore(data: pd.DataFrame, adaptive_windows: pd.DataFrame, column_pairs: pd.Index, min_window: int) -> np.ndarray:
+        """
+        Run the adaptive Z-score kernel on the columns of data, using the window sizes of each column's pair.
+        """
+        values = np.asfortranarray(data.to_numpy(dtype=np.float64))
+        windows = np.asfortranarray(adaptive_windows[column_pairs].to_numpy(dtype=np.int64))
+        out = np.empty(values.shape, dtype=np.float64, order='F')
+        adaptive_zscore_2d(values, windows, min_window, out)
+        return out
+
+
+def _warmup():
+    """
+    Compile the Z-score kernels on tiny inputs with the same argument types the features pass them, so the
+    first real call doesn't stall on JIT. With cache=True this mostly loads the compiled code from disk.
+    """
+    rolling_zscore(np.ones((8, 2)), 4, 2)
+    values = np.ones((8, 2), order='F')
+    windows = np.full((8, 2), 4, dtype=np.int64, order='F')
+    adaptive_zscore_2d(values, windows, 2, np.empty((8, 2), order='F'))
+    rolling_quantile_2d(values, 4, 4, 0.95, np.empty((8, 2), order='F'))
+
+if os.environ.get('HORCRUX_WARMUP'):
+    _warmup()